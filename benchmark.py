@@ -0,0 +1,305 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import shutil
+import threading
+import contextlib
+import subprocess
+from statistics import median
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+# Synthetic benchmark of discovery, ordering, environment rewrite and apply. A repository is generated on disk, its
+# change set is served by a local diffs/commits endpoint and the deployment runs against an in-process fake
+# Snowflake connection, so results only depend on this code and can be compared across commits.
+#
+#   python benchmark.py --files 2000 --depth 4 --order-lines 200 --script-kb 4 --latency-ms 2 --output results.json
+#   python benchmark.py --compare results.json
+
+_repository_id = 'benchmark-repo'
+_base_version = 'base'
+_target_version = 'target'
+
+
+class FakeSnowflakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = []
+        self.sfqid = None
+        self.multi_statement_savedIds = []
+
+    def execute(self, query, params=None, num_statements=None):
+        # A multi-statement query is one round trip, the IDs of its statements come with the result
+        self.connection.queries += 1
+        if self.connection.latency:
+            time.sleep(self.connection.latency)
+        self.sfqid = f"benchmark-{self.connection.queries}"
+        self.multi_statement_savedIds = [f"{self.sfqid}-{statement}" for statement in range(num_statements or 0)]
+        self.rows = self.connection.rows_for(query)
+        return self
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def close(self):
+        pass
+
+    def __iter__(self):
+        return iter(self.rows)
+
+
+class FakeSnowflakeConnection:
+    # Enough of snowflake.connector's connection for snowchange, every statement costs latency seconds
+    session_ids = iter(range(1, sys.maxsize))
+
+    def __init__(self, database, user, latency):
+        self.database = database
+        self.user = user
+        self.latency = latency
+        self.session_id = next(FakeSnowflakeConnection.session_ids)
+        self.queries = 0
+
+    def rows_for(self, query):
+        if query.startswith("SHOW WAREHOUSES"):
+            return [('BENCHMARK_WH', 'STARTED', 'STANDARD', 'X-Small')]
+        return []
+
+    def cursor(self):
+        return FakeSnowflakeCursor(self)
+
+    def execute_string(self, query, **kwargs):
+        return [self.cursor().execute(query)]
+
+    def autocommit(self, mode):
+        self.cursor().execute(f"ALTER SESSION SET AUTOCOMMIT = {mode}")
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def generate_repository(repository_dir, files, depth, order_lines, script_kb, v_ratio, account_files, seed):
+    # coEDW/<depth folders>/<scripts>, the order file lists order_lines of the folders. Scripts reference the
+    # databases replace_env rewrites and are padded with statements up to script_kb
+    rng = random.Random(seed)
+    folder_count = max(order_lines, 1)
+    folders = []
+    for folder_number in range(folder_count):
+        parts = ['coEDW'] + [f"level{level}_{rng.randrange(folder_count)}" for level in range(depth - 1)] + [f"folder{folder_number}"]
+        folders.append('/'.join(parts))
+
+    statement = "INSERT INTO COEDW.STAGING.EVENTS SELECT * FROM LAKEHOUSE.RAW.EVENTS WHERE ID > 0;\n"
+    padding = statement * max(int(script_kb * 1024 / len(statement)), 1)
+    changes = []
+    for file_number in range(files):
+        folder = folders[file_number % len(folders)]
+        name = f"V_{file_number}__change.sql" if rng.random() < v_ratio else f"view_{file_number}.sql"
+        body = f"CREATE OR REPLACE VIEW COEDW.REPORTING.VIEW_{file_number} AS SELECT * FROM CO_SHARED.DIM.CUSTOMER;\n{padding}"
+        if rng.random() < 0.1:
+            body += "ALTER WAREHOUSE ELT SET WAREHOUSE_SIZE = 'SMALL';\n"
+        changes.append(write_script(repository_dir, f"{folder}/{name}", body))
+
+    for file_number in range(account_files):
+        name = f"V_{file_number}__grant.sql" if file_number % 2 == 0 else f"grant_{file_number}.sql"
+        changes.append(write_script(repository_dir, f"coEDW/post_prod_deployment/{name}", f"GRANT USAGE ON DATABASE COEDW TO ROLE REPORTING_{file_number};\n"))
+
+    rng.shuffle(changes)
+    with open(os.path.join(repository_dir, 'order_file.txt'), 'w') as order_file:
+        for folder in folders:
+            order_file.write(folder + '\n')
+    return changes
+
+
+def write_script(repository_dir, relative_path, body):
+    full_path = os.path.join(repository_dir, relative_path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    with open(full_path, 'w') as script_file:
+        script_file.write(body)
+    return {'item': {'path': '/' + relative_path, 'isFolder': False}, 'changeType': 'edit'}
+
+
+def start_diff_server(changes, latency):
+    # Serves the change set page by page like GET {repository}/diffs/commits?$top=..&$skip=..
+    class DiffHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            query = parse_qs(urlparse(self.path).query)
+            top = int(query.get('$top', ['100'])[0])
+            skip = int(query.get('$skip', ['0'])[0])
+            if latency:
+                time.sleep(latency)
+            body = json.dumps({'changes': changes[skip:skip + top]}).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), DiffHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def measure(name, function, repeat, results):
+    # Best and median of repeat runs, output of the measured code is discarded
+    runs = []
+    for _ in range(repeat):
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            function()
+            runs.append(time.perf_counter() - start)
+    results[name] = {'seconds_min': min(runs), 'seconds_median': median(runs), 'runs': runs}
+    print(f"{name:<32} min {min(runs):9.4f}s  median {median(runs):9.4f}s")
+
+
+def measure_command(name, command, repeat, results, cwd=None):
+    # Like measure for a fresh interpreter, so the time includes starting Python and importing snowchange
+    def run():
+        subprocess.run(command, cwd=cwd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=120)
+    measure(name, run, repeat, results)
+
+
+def run_benchmark(args):
+    import snowchange
+    import utility
+
+    repository_dir = tempfile.mkdtemp(prefix='snowchange_benchmark_')
+    previous_dir = os.getcwd()
+    server = None
+    empty_server = None
+    try:
+        changes = generate_repository(repository_dir, args.files, args.depth, args.order_lines, args.script_kb, args.v_ratio, args.account_files, args.seed)
+        server, base_url = start_diff_server(changes, args.api_latency_ms / 1000)
+        # A build without SQL changes, snowchange has to finish it without connecting to Snowflake
+        empty_server, empty_base_url = start_diff_server([], args.api_latency_ms / 1000)
+        # Order file lines are relative to the repository, skip the components of its absolute path
+        root_depth = len(repository_dir.split('/'))
+        order_file = os.path.join(repository_dir, 'order_file.txt')
+        os.chdir(repository_dir)
+
+        def diff_client():
+            return contextlib.closing(utility.AzureDevOpsDiffClient('token', _repository_id, base_url=base_url, max_workers=args.diff_max_workers))
+
+        # The client is checked against the stub server before anything is timed: all pages are fetched and the
+        # change set comes back complete and in order
+        with diff_client() as client:
+            if client.get_changes(_base_version, _target_version) != changes:
+                raise ValueError(f"The diff client did not return the {len(changes)} change(s) served by the stub server")
+
+        def get_incremental_changes_list():
+            with diff_client() as client:
+                utility.get_incremental_changes_list(_target_version, _base_version, repository_dir, 'token', _repository_id, '0', 'coedw_pipeline_benchmark', client)
+
+        def get_modified_files():
+            with diff_client() as client:
+                utility.get_modified_files(_target_version, None, False, False, None, _base_version, snowchange.execute_snowflake_query, repository_dir, 'token', order_file, _repository_id, 'coedw_pipeline_benchmark', '0', '/coEDW/', root_depth, client)
+
+        def get_account_modified_files():
+            with diff_client() as client:
+                utility.get_account_modified_files(_target_version, None, False, False, None, _base_version, snowchange.execute_snowflake_query, repository_dir, 'token', _repository_id, 'account_pipeline_benchmark', '1', client)
+
+        contents = []
+        for change in changes:
+            with open(repository_dir + change['item']['path']) as script_file:
+                contents.append(script_file.read())
+
+        def replace_env():
+            for content in contents:
+                for database_environment in ('dev', 'tst', 'prd'):
+                    snowchange.replace_env(content, database_environment)
+
+        def connect(*connect_args, **connect_kwargs):
+            return FakeSnowflakeConnection('COEDW_DEV', 'BENCHMARK', args.latency_ms / 1000)
+
+        def full_run():
+            snowchange.snowchange(repository_dir, 'benchmark', 'BENCHMARK', 'DEPLOYER', 'BENCHMARK_WH', 'COEDW_DEV', 'DEPLOY.CHANGE_HISTORY', '1', '20240101000000', None, False, False, '0', 'coedw_pipeline_benchmark', 'dev', 'DEPLOY.BUILD_INFORMATION', _base_version, _target_version, 'token', _repository_id, {}, order_root_depth=root_depth, azure_devops_url=base_url, diff_max_workers=args.diff_max_workers, parallel=args.parallel, coalesce_max_kb=args.coalesce_kb)
+
+        os.environ.setdefault('SNOWSQL_PWD', 'benchmark')
+        original_connect = snowchange.get_snowflake_connection
+        snowchange.get_snowflake_connection = connect
+        results = dict()
+        snowchange_file = os.path.abspath(snowchange.__file__)
+        measure_command('startup_import', [sys.executable, '-c', 'import snowchange'], args.repeat, results, cwd=os.path.dirname(snowchange_file))
+        measure_command('startup_help', [sys.executable, snowchange_file, '--help'], args.repeat, results)
+        measure_command('startup_nothing_to_deploy', [sys.executable, snowchange_file, '-f', repository_dir, '-a', 'benchmark', '-u', 'BENCHMARK', '-r', 'DEPLOYER', '-w', 'BENCHMARK_WH', '-d', 'COEDW_DEV', '-c', 'DEPLOY.CHANGE_HISTORY', '-b', '1', '-t', '20240101000000', '-pn', 'coedw_pipeline_benchmark', '-de', 'dev', '-lsi', _base_version, '-ch', _target_version, '-st', 'token', '-rid', _repository_id, '-adu', empty_base_url, '-ord', str(root_depth)], args.repeat, results, cwd=repository_dir)
+        try:
+            measure('get_incremental_changes_list', get_incremental_changes_list, args.repeat, results)
+            measure('get_modified_files', get_modified_files, args.repeat, results)
+            measure('get_account_modified_files', get_account_modified_files, args.repeat, results)
+            measure('replace_env', replace_env, args.repeat, results)
+            measure('snowchange', full_run, args.repeat, results)
+        finally:
+            snowchange.get_snowflake_connection = original_connect
+        return results
+    finally:
+        os.chdir(previous_dir)
+        if server is not None:
+            server.shutdown()
+        if empty_server is not None:
+            empty_server.shutdown()
+        shutil.rmtree(repository_dir, ignore_errors=True)
+
+
+def get_commit():
+    result = subprocess.run(['git', '-C', os.path.dirname(os.path.abspath(__file__)), 'rev-parse', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return result.stdout.decode('utf-8').strip() or None
+
+
+def compare_results(previous, current):
+    print('.....')
+    print(f"Compared with {previous.get('commit')}")
+    for name, result in current['results'].items():
+        before = previous.get('results', {}).get(name)
+        if before is None:
+            continue
+        change = (result['seconds_min'] - before['seconds_min']) / before['seconds_min'] * 100 if before['seconds_min'] else 0
+        print(f"{name:<32} {before['seconds_min']:9.4f}s -> {result['seconds_min']:9.4f}s  ({change:+.1f}%)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python benchmark.py', description='Benchmark snowchange discovery, ordering, rewrite and apply on a synthetic repository.')
+    parser.add_argument('--files', type=int, default=1000, help='Number of change scripts in the change set (default: 1000)')
+    parser.add_argument('--depth', type=int, default=4, help='Folder depth of the scripts below coEDW (default: 4)')
+    parser.add_argument('--order-lines', type=int, default=200, help='Number of folders listed in the order file (default: 200)')
+    parser.add_argument('--script-kb', type=float, default=2, help='Approximate size of every script in KB (default: 2)')
+    parser.add_argument('--v-ratio', type=float, default=0.2, help='Share of V scripts (default: 0.2)')
+    parser.add_argument('--account-files', type=int, default=50, help='Number of post_prod_deployment scripts for the account level discovery (default: 50)')
+    parser.add_argument('--latency-ms', type=float, default=1, help='Latency of every fake Snowflake statement in milliseconds (default: 1)')
+    parser.add_argument('--api-latency-ms', type=float, default=5, help='Latency of every diff page request in milliseconds (default: 5)')
+    parser.add_argument('--diff-max-workers', type=int, default=4, help='Diff pages requested concurrently (default: 4)')
+    parser.add_argument('--parallel', type=int, help='Parallel sessions for the full run (default: sequential)')
+    parser.add_argument('--coalesce-kb', type=float, help='Coalesce R scripts of up to this many KB in the full run (default: off)')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of every measurement (default: 3)')
+    parser.add_argument('--seed', type=int, default=1, help='Seed of the generated repository (default: 1)')
+    parser.add_argument('--output', type=str, help='Write the results as JSON to this file')
+    parser.add_argument('--compare', type=str, help='JSON results of an earlier run to compare with')
+    args = parser.parse_args()
+
+    results = {
+        'commit': get_commit(),
+        'python': platform.python_version(),
+        'parameters': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        'results': run_benchmark(args)
+    }
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+        print(f"Results written to {args.output}")
+    if args.compare:
+        with open(args.compare) as compare_file:
+            compare_results(json.load(compare_file), results)
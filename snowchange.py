@@ -1,10 +1,19 @@
 import os
+import sys
 import argparse
+import contextlib
+import inspect
+import logging
+import logging.handlers
 import json
 import time
 import hashlib
-import snowflake.connector
-from utility import get_modified_files, get_account_modified_files, extract_env, replace_warehouse_name, update_warehouse_size, revert_warehouse_size
+import queue
+import re
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from utility import get_modified_files, get_account_modified_files, load_env_config, get_environment_database, EnvironmentRewriter, update_warehouse_size, revert_warehouse_size, get_warehouse_size, normalize_warehouse_size, warehouse_sizes, get_script_runtime_history, get_query_stats, summarize_query_stats, advise_warehouse_size, build_dependency_plan, split_sql_statements, is_executable_statement, sql_comment_pattern, AzureDevOpsDiffClient, GitChangeSource, TimedChangeSource, SharedChangeSource, ScriptMetadataCache, DeploymentCheckpoint, RunMetrics, azure_devops_base_url, logger
 
 # Set a few global variables here
 _snowchange_version = '2.2.0'
@@ -14,53 +23,138 @@ _metadata_buildinfo_table_name = 'BUILD_INFORMATION'
 
 orderfile = "order_file.txt"
 
-env_dict_lakehouse = {"dev":"LAKEHOUSE_DEV","prd":"LAKEHOUSE","tst":"LAKEHOUSE_TEST"}
-env_db_list_lakehouse = ["LAKEHOUSE","LAKEHOUSE_DEV","LAKEHOUSE_TEST"]
+# Database families, warehouses, stages and excluded files of every environment
+env_config_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "env_config.json")
+env_config = load_env_config(env_config_file)
 
-env_dict_coedw = {"dev":"COEDW_DEV","prd":"COEDW","tst":"COEDW_TEST","preprod":"COEDW_PREPROD"}
-env_db_list_coedw = ["COEDW","COEDW_DEV","COEDW_TEST","COEDW_PREPROD"]
+exclude_files = env_config['exclude_files']
 
-env_dict_system_integration = {"dev":"SYSTEM_INTEGRATION_DEV","prd":"SYSTEM_INTEGRATION","tst":"SYSTEM_INTEGRATION_TEST"}
-env_db_list_system_integration = ["SYSTEM_INTEGRATION","SYSTEM_INTEGRATION_DEV","SYSTEM_INTEGRATION_TEST"]
+env_stage_list = env_config['stages']
 
-env_dict_CO_DATASCIENCELAB = {"dev":"CO_DATASCIENCELAB_DEV","prd":"CO_DATASCIENCELAB","tst":"CO_DATASCIENCELAB_TEST"}
-env_db_list_CO_DATASCIENCELAB = ["CO_DATASCIENCELAB","CO_DATASCIENCELAB_DEV","CO_DATASCIENCELAB_TEST"]
-
-env_dict_CO_PLANDATA = {"dev":"CO_PLANDATA_DEV","prd":"CO_PLANDATA","tst":"CO_PLANDATA_TEST"}
-env_db_list_CO_PLANDATA = ["CO_PLANDATA","CO_PLANDATA_DEV","CO_PLANDATA_TEST"]
-
-env_dict_CO_SHARED = {"dev":"CO_SHARED_DEV","prd":"CO_SHARED","tst":"CO_SHARED_TEST"}
-env_db_list_CO_SHARED = ["CO_SHARED","CO_SHARED_DEV","CO_SHARED_TEST"]
-
-
-exclude_files = ["sp_clone_from_prod_to_preprod.sql", "sp_clone_from_prod_to_devtest.sql"]
+# Map environment to warehouse names
+env_dict_warehouse = env_config['warehouses']
 
 
-env_stage_list = {"COEDW_DEV":"@STAGE.DEV_CSV_STAGE","COEDW":"@STAGE.PRD_CSV_STAGE","COEDW_TEST":"@STAGE.TST_CSV_STAGE","COEDW_PREPROD":"@STAGE.UAT_CSV_STAGE"}
+def get_database_aliases():
+    # Every environment specific database name mapped to the first (production) name of its family
+    database_aliases = dict()
+    for family in env_config['database_families']:
+        for env_db in family['databases']:
+            database_aliases[env_db] = family['databases'][0]
+    return database_aliases
 
-# Map environment to warehouse names
-env_dict_warehouse = {
-  "dev": {"ELT_DEV_TEST": "ELT_DEV_TEST", "ELT": "ELT_DEV_TEST"},
-  "tst": {"ELT_DEV_TEST": "ELT_DEV_TEST", "ELT": "ELT_DEV_TEST"},
-  "preprod": {"ELT_DEV_TEST": "ELT", "ELT": "ELT"},
-  "prd": {"ELT_DEV_TEST": "ELT", "ELT": "ELT"}
-  }
 
+def get_snowflake_connection(snowflake_account, snowflake_user, snowflake_role, snowflake_warehouse, snowflake_database, snowflake_password, snowflake_authenticator='snowflake'):
+    # The connector takes longer to import than a run with nothing to deploy takes altogether, it is loaded for the first login
+    import snowflake.connector
 
-def get_snowflake_connection():
     snowflake_connection = snowflake.connector.connect(
-      user=os.environ["SNOWFLAKE_USER"],
-      account=os.environ["SNOWFLAKE_ACCOUNT"],
-      role=os.environ["SNOWFLAKE_ROLE"],
-      warehouse=os.environ["SNOWFLAKE_WAREHOUSE"],
-      database=os.environ["SNOWFLAKE_DATABASE"],
-      authenticator=os.environ["SNOWFLAKE_AUTHENTICATOR"],
-      password=os.environ["SNOWSQL_PWD"]
+      user=snowflake_user,
+      account=snowflake_account,
+      role=snowflake_role,
+      warehouse=snowflake_warehouse,
+      database=snowflake_database,
+      authenticator=snowflake_authenticator,
+      password=snowflake_password
     )
     return snowflake_connection
 
 
-def snowchange(root_folder, snowflake_account, snowflake_user, snowflake_role, snowflake_warehouse, snowflake_database, change_history_table_override, build_id, build_start_time, vars, autocommit, verbose, account_level_file, pipeline_name, database_environment, build_info_table, last_success_build_id, current_head, access_token, repository_id, deployment_warehouse_size_dict):
+class SnowflakeConnectionManager:
+    # Logs in once and hands the session to the warehouse resize, the deployment and the build bookkeeping,
+    # switching its role where needed (CO_ADMIN for the resize). Extra sessions for parallel apply are pooled and
+    # reused, every login is timed and reported when the manager is closed.
+
+    def __init__(self, snowflake_account, snowflake_user, snowflake_role, snowflake_warehouse, snowflake_database, snowflake_password, autocommit=False, verbose=False, max_idle_sessions=8, metrics=None):
+        self.snowflake_account = snowflake_account
+        self.snowflake_user = snowflake_user
+        self.snowflake_role = snowflake_role
+        self.snowflake_warehouse = snowflake_warehouse
+        self.snowflake_database = snowflake_database
+        self.snowflake_password = snowflake_password
+        self.autocommit = autocommit
+        self.verbose = verbose
+        self.max_idle_sessions = max_idle_sessions
+        self.metrics = metrics
+        self.idle_sessions = []
+        self.session_roles = dict()
+        self.connect_seconds = []
+        self.lock = threading.Lock()
+
+    def connect(self):
+        start = time.perf_counter()
+        session = get_snowflake_connection(self.snowflake_account, self.snowflake_user, self.snowflake_role, self.snowflake_warehouse, self.snowflake_database, self.snowflake_password)
+        seconds = time.perf_counter() - start
+        print(f"Connected to Snowflake as {self.snowflake_user} in {seconds:.2f}s")
+        if self.metrics is not None:
+            self.metrics.add_phase('connect', seconds)
+        with self.lock:
+            self.connect_seconds.append(seconds)
+            self.session_roles[session] = self.snowflake_role.upper()
+        # The session starts in the database and warehouse it was opened with, queries on it stay there
+        register_query_executor(session, SnowflakeQueryExecutor(session, self.snowflake_database, self.autocommit, self.verbose, self.snowflake_warehouse))
+        return session
+
+    def acquire(self, role=None, database=None):
+        # A manager shared by the deployments of a batch hands out its sessions for other databases as well
+        with self.lock:
+            session = self.idle_sessions.pop() if self.idle_sessions else None
+        if session is None:
+            session = self.connect()
+        self.use_role(session, role or self.snowflake_role)
+        if database:
+            get_query_executor(session, self.autocommit, self.verbose).set_database(database)
+        return session
+
+    def release(self, session):
+        with self.lock:
+            if len(self.idle_sessions) < self.max_idle_sessions:
+                self.idle_sessions.append(session)
+                return
+        session.close()
+
+    def use_role(self, session, role):
+        if self.session_roles.get(session) == role.upper():
+            return
+        cursor = session.cursor()
+        try:
+            cursor.execute(f"USE ROLE {role}")
+        finally:
+            cursor.close()
+        self.session_roles[session] = role.upper()
+        get_query_executor(session, self.autocommit, self.verbose).forget_session_state()
+
+    @contextlib.contextmanager
+    def role(self, session, role):
+        # Run a block under another role on the session, switching back to the deployment role afterwards
+        self.use_role(session, role)
+        try:
+            yield session
+        finally:
+            self.use_role(session, self.snowflake_role)
+
+    def close(self):
+        with self.lock:
+            sessions, self.idle_sessions = self.idle_sessions, []
+        for session in sessions:
+            session.close()
+        if self.connect_seconds:
+            print(f"Opened {len(self.connect_seconds)} Snowflake session(s), {sum(self.connect_seconds):.2f}s spent connecting")
+
+
+def snowchange(root_folder, snowflake_account, snowflake_user, snowflake_role, snowflake_warehouse, snowflake_database, change_history_table_override, build_id, build_start_time, vars, autocommit, verbose, account_level_file, pipeline_name, database_environment, build_info_table, last_success_build_id, current_head, access_token, repository_id, deployment_warehouse_size_dict, parallel=None, dependency_order=False, order_root_depth=9, diff_cache_dir=None, diff_max_workers=4, change_source_type='rest', change_source_paths=None, skip_unchanged=False, history_batch_size=50, history_flush_seconds=30, stream_min_mb=None, adaptive_warehouse_size=False, warehouse_target_seconds=900, warehouse_credit_budget=None, plan_file=None, plan_max_seconds=None, azure_devops_url=None, metrics_file=None, metrics_format='json', slowest_scripts=10, async_apply=None, async_poll_seconds=1, metadata_cache_file=None, metadata_cache_size=50000, resume=False, checkpoint_file=None, coalesce_max_kb=None, coalesce_max_statements=50, migrate_change_history=False, script_catalog=None, change_source=None, connection_manager=None):
+    # Kept for the environment fan-out, which runs this function again per environment with the same arguments
+    deployment_arguments = dict(locals())
+    run_start = time.perf_counter()
+
+    # Several environments are deployed concurrently from one discovery, see deploy_environments
+    if isinstance(database_environment, (list, tuple)):
+        database_environments = list(dict.fromkeys(database_environment))
+        database_environment = database_environments[0] if len(database_environments) == 1 else None
+    else:
+        database_environments = [database_environment]
+    metrics = RunMetrics(labels={'pipeline': pipeline_name, 'environment': ','.join(str(environment) for environment in database_environments), 'database': snowflake_database, 'build_id': build_id})
+
     if "SNOWSQL_PWD" not in os.environ:
         raise ValueError("The SNOWSQL_PWD environment variable has not been defined")
 
@@ -68,6 +162,18 @@ def snowchange(root_folder, snowflake_account, snowflake_user, snowflake_role, s
     if not os.path.isdir(root_folder):
         raise ValueError("Invalid root folder: %s" % root_folder)
 
+    if async_apply and async_apply > 1:
+        if parallel and parallel > 1:
+            raise ValueError("Parallel sessions and asynchronous apply cannot be combined, choose one of them")
+        if not autocommit:
+            # Concurrent queries of one session would share its open transaction
+            raise ValueError("Asynchronous apply requires autocommit")
+    if plan_file == '-' and len(database_environments) > 1:
+        # The plans of concurrent environments would be interleaved on the console
+        raise ValueError("A plan for several environments cannot be written to the console, give a file name for --plan")
+    if coalesce_max_kb and ((parallel and parallel > 1) or (async_apply and async_apply > 1)):
+        raise ValueError("Coalescing small scripts applies to the sequential apply, it cannot be combined with parallel sessions or asynchronous apply")
+
     print("snowchange version: %s" % _snowchange_version)
     print("Using root folder %s" % root_folder)
     print("Using variables %s" % vars)
@@ -76,129 +182,676 @@ def snowchange(root_folder, snowflake_account, snowflake_user, snowflake_role, s
     print("Using Snowflake role %s" % snowflake_role)
     print("Using Snowflake warehouse %s" % snowflake_warehouse)
     print("Using Snowflake database %s" % snowflake_database)
+    if len(database_environments) > 1:
+        print("Deploying to environments %s" % ', '.join(database_environments))
+    if parallel and parallel > 1:
+        print("Applying R scripts with %d parallel sessions" % parallel)
+    if async_apply and async_apply > 1:
+        print("Applying R scripts with up to %d asynchronous queries" % async_apply)
+    if coalesce_max_kb:
+        print("Submitting R scripts of up to %s KB together, up to %d statements per query" % (coalesce_max_kb, coalesce_max_statements))
+    if dependency_order:
+        print("Ordering scripts by their object dependencies instead of %s" % orderfile)
+    if resume:
+        print("Resuming build %s after the scripts it already applied" % build_id)
+    stream_min_bytes = None
+    if stream_min_mb is not None:
+        stream_min_bytes = int(stream_min_mb * 1024 * 1024)
+        print("Streaming change scripts of %s MB and more statement by statement" % stream_min_mb)
+
+    # Get the change history table details
+    change_history_table = get_change_history_table_details(change_history_table_override, snowflake_database)
+
+    # Get build information table details
+    buildid_info_table = get_build_information_table_details(build_info_table, snowflake_database)
+
+    # Details and checksums of scripts unchanged since an earlier run on this agent are taken from the cache
+    metadata_cache = None
+    if metadata_cache_file:
+        metadata_cache = ScriptMetadataCache(metadata_cache_file, metadata_cache_size, get_env_config_fingerprint())
+
+    # A catalog is passed in when the discovery was already done for several environments at once, a change
+    # source when the diff is shared by the deployments of a batch
+    if script_catalog is None:
+        if change_source is None and change_source_type == 'git':
+            # The diff is computed from the local checkout, no API call is needed
+            change_source = GitChangeSource(root_folder, change_source_paths)
+        elif change_source is None:
+            # The diff is fetched over one pooled session and cached per commit range when a cache folder is given
+            change_source = AzureDevOpsDiffClient(access_token, repository_id, base_url=azure_devops_url or azure_devops_base_url, cache_dir=diff_cache_dir, max_workers=diff_max_workers)
+        change_source = TimedChangeSource(change_source, metrics)
+
+        # Find all scripts in the root folder (recursively) and sort them correctly, discovery includes the diff fetch
+        try:
+            with metrics.phase('discovery'):
+                if account_level_file == "1":
+                    script_catalog = get_all_scripts_recursively_account(root_folder, verbose, last_success_build_id, current_head, access_token, buildid_info_table, None, autocommit, repository_id, pipeline_name, change_source, metadata_cache)
+                else:
+                    script_catalog = get_all_scripts_recursively_coedw(root_folder, verbose, last_success_build_id, current_head, access_token, buildid_info_table, None, autocommit, repository_id, account_level_file, pipeline_name, None if dependency_order else orderfile, order_root_depth, change_source, metadata_cache)
+        finally:
+            change_source.close()
+
+    if script_catalog.v_scripts:
+        print('.....')
+        print("V Scripts modified since last build")
+        for script in script_catalog.v_scripts:
+            print(script.script_name)
+    else:
+        print("There are no V Scripts modified since the last build")
 
-    # TODO: Is there a better way to do this without setting environment variables?
-    os.environ["SNOWFLAKE_ACCOUNT"] = snowflake_account
-    os.environ["SNOWFLAKE_USER"] = snowflake_user
-    os.environ["SNOWFLAKE_ROLE"] = snowflake_role
-    os.environ["SNOWFLAKE_WAREHOUSE"] = snowflake_warehouse
-    os.environ["SNOWFLAKE_DATABASE"] = snowflake_database
-    os.environ["SNOWFLAKE_AUTHENTICATOR"] = 'snowflake'
+    if script_catalog.r_scripts:
+        print('.....')
+        print("R Scripts modified since last build")
+        for script in script_catalog.r_scripts:
+            print(script.script_name)
+    else:
+        print("There are no R Scripts modified since the last build")
+
+    ordering_start = time.perf_counter()
+
+    # Apply V scripts first and then R scripts, in the order discovery returned them
+    all_scripts = list(script_catalog)
+
+    if dependency_order:
+        # Reorder by the objects each script creates and references, every wave becomes an apply tier
+        waves = build_dependency_plan(all_scripts, get_database_aliases())
+        print('.....')
+        print(f"Dependency plan with {len(waves)} wave(s)")
+        for tier, wave in enumerate(waves):
+            print(f"Wave {tier}: {', '.join(script.script_name for script in wave)}")
+        all_scripts = [script for wave in waves for script in wave]
+        script_catalog.set_apply_order(all_scripts)
+    metrics.add_phase('ordering', time.perf_counter() - ordering_start)
+
+    if len(script_catalog) == 0 and not plan_file:
+        # Nothing to deploy: no login, no warehouse resize and no build information, the connector is not even loaded
+        print(".....")
+        print("No change scripts to deploy, not connecting to Snowflake")
+        if metadata_cache is not None:
+            metadata_cache.save()
+        metrics.set_counter('scripts_applied', 0)
+        metrics.set_counter('scripts_skipped', 0)
+        metrics.add_phase('total', time.perf_counter() - run_start)
+        print_phase_summary(metrics)
+        if metrics_file:
+            metrics.write(metrics_file, metrics_format)
+        print("Completed successfully")
+        return {'scripts_applied': 0, 'scripts_skipped': 0, 'scripts_resumed': 0}
+
+    if len(database_environments) > 1:
+        if metadata_cache is not None:
+            metadata_cache.save()
+        return deploy_environments(deployment_arguments, database_environments, script_catalog)
+
+    # Discovery and ordering are done, only now connect and resize the warehouse. One login serves the resize,
+    # the deployment and the revert
+    print("Getting Snowflake Connection")
+    shared_connection_manager = connection_manager is not None
+    if not shared_connection_manager:
+        connection_manager = SnowflakeConnectionManager(snowflake_account, snowflake_user, snowflake_role, snowflake_warehouse, snowflake_database, os.environ["SNOWSQL_PWD"], autocommit, verbose, metrics=metrics)
+    snowflake_connection = connection_manager.acquire(database=snowflake_database)
+
+    # A rerun of a failed build continues with the first script it did not apply yet. What was applied is read from
+    # CHANGE_HISTORY in one query, the checkpoint adds the scripts whose rows were not written before the run stopped
+    checkpoint = DeploymentCheckpoint(checkpoint_file, build_id, current_head, pipeline_name, snowflake_database) if checkpoint_file else None
+    history_columns = get_change_history_columns(snowflake_connection, change_history_table)
+    build_applied_scripts = dict()
+    checkpointed_scripts = dict()
+    pending_scripts = all_scripts
+    if resume:
+        build_applied_scripts = get_build_applied_scripts(snowflake_connection, change_history_table, autocommit, verbose, build_id, pipeline_name, current_head, history_columns)
+        if checkpoint is not None:
+            checkpointed_scripts = checkpoint.load()
+        # Only scripts that are still what was applied count as applied, a changed script runs again
+        current_checksums = {script_path: get_script_checksum(script_catalog.get(script_path), database_environment, stream_min_bytes, metadata_cache) for script_path in set(build_applied_scripts) | set(checkpointed_scripts) if script_path in script_catalog}
+        changed_script_paths = sorted({script_path for script_path, checksum in build_applied_scripts.items() if script_path in current_checksums and current_checksums[script_path] != checksum}
+                                      | {script_path for script_path, entry in checkpointed_scripts.items() if script_path in current_checksums and current_checksums[script_path] != entry['checksum']})
+        for script_path in changed_script_paths:
+            print(f"Change script {script_path} changed since this build applied it, it is applied again")
+        build_applied_scripts = {script_path: checksum for script_path, checksum in build_applied_scripts.items() if current_checksums.get(script_path) == checksum}
+        checkpointed_scripts = {script_path: entry for script_path, entry in checkpointed_scripts.items() if current_checksums.get(script_path) == entry['checksum']}
+        pending_scripts = get_resumed_scripts(all_scripts, set(build_applied_scripts) | set(checkpointed_scripts), database_environment)
 
     # Get desired size from mapping
-    deployment_warehouse_size = deployment_warehouse_size_dict.get(database_environment)
+    deployment_warehouse_size = (deployment_warehouse_size_dict or {}).get(database_environment)
+
+    if plan_file:
+        # Plan mode only reads the change history, nothing is resized or executed. Runtimes are predicted at the mapped size
+        runtime_history = get_script_runtime_history(snowflake_connection, autocommit, verbose, change_history_table, [script.script_full_path for script in pending_scripts], execute_snowflake_query, history_columns, deployment_warehouse_size)
+        applied_checksums = get_applied_checksums(snowflake_connection, change_history_table, autocommit, verbose) if skip_unchanged else None
+        connection_manager.release(snowflake_connection)
+        if not shared_connection_manager:
+            connection_manager.close()
+
+        plan = build_deployment_plan(pending_scripts, database_environment, runtime_history, applied_checksums, parallel, stream_min_bytes, metadata_cache=metadata_cache)
+        if metadata_cache is not None:
+            metadata_cache.save()
+        plan['pipeline_name'] = pipeline_name
+        plan['database'] = snowflake_database
+        plan['last_success_build_id'] = last_success_build_id
+        plan['current_head'] = current_head
+        write_deployment_plan(plan, plan_file)
+        if plan_max_seconds is not None and plan['predicted_seconds'] > plan_max_seconds:
+            raise ValueError(f"Predicted deployment time {plan['predicted_seconds']:.0f}s exceeds the limit of {plan_max_seconds:.0f}s")
+        return plan
+
+    warehouse_resize_start = time.perf_counter()
+
+    predicted_seconds = None
+    current_size = None
+    if adaptive_warehouse_size:
+        # Size the warehouse for this change set from the runtimes recorded by earlier deployments. The mapped size
+        # is the largest size used, the history is converted to it from the size each row was recorded at
+        with connection_manager.role(snowflake_connection, "CO_ADMIN"):
+            current_size = get_warehouse_size(snowflake_connection, snowflake_warehouse)
+        max_size = deployment_warehouse_size or current_size
+        runtime_history = get_script_runtime_history(snowflake_connection, autocommit, verbose, change_history_table, [script.script_full_path for script in pending_scripts], execute_snowflake_query, history_columns, max_size)
+        deployment_warehouse_size, predicted_seconds = advise_warehouse_size([script.script_full_path for script in pending_scripts], runtime_history, current_size, max_size, max_size, warehouse_target_seconds, warehouse_credit_budget)
+        if not deployment_warehouse_size:
+            print(f"Warehouse {snowflake_warehouse} stays at {current_size} for this deployment")
 
     if deployment_warehouse_size:
-        original_size, size_changed = update_warehouse_size(
-          user=snowflake_user,
-          account=snowflake_account,
-          role="CO_ADMIN",
-          warehouse=snowflake_warehouse,
-          database=snowflake_database,
-          authenticator='snowflake',
-          password=os.environ["SNOWSQL_PWD"],
-          deployment_warehouse_size=deployment_warehouse_size
-          )
+        with connection_manager.role(snowflake_connection, "CO_ADMIN"):
+            original_size, size_changed = update_warehouse_size(snowflake_connection, snowflake_warehouse, deployment_warehouse_size)
     else:
-        print(f"No warehouse size mapping found for environment '{database_environment}'. Skipping warehouse size update.")
+        if not adaptive_warehouse_size:
+            print(f"No warehouse size mapping found for environment '{database_environment}'. Skipping warehouse size update.")
         original_size = None
         size_changed = False
-        print("Getting Snowflake Connection")
-
-    snowflake_connection = get_snowflake_connection()
+    # The size the scripts run at is recorded with their rows, later predictions convert the runtimes from it
+    warehouse_size = deployment_warehouse_size or current_size
+    if warehouse_size is None and 'WAREHOUSE_SIZE' in history_columns:
+        with connection_manager.role(snowflake_connection, "CO_ADMIN"):
+            warehouse_size = get_warehouse_size(snowflake_connection, snowflake_warehouse)
+    metrics.add_phase('warehouse_resize', time.perf_counter() - warehouse_resize_start)
 
     scripts_applied = 0
     scripts_skipped = 0
-
-    # Get the change history table details
-    change_history_table = get_change_history_table_details(change_history_table_override)
-
-    # Get build information table details
-    buildid_info_table = get_build_information_table_details(build_info_table)
-
-    # Find all scripts in the root folder (recursively) and sort them correctly
-    if account_level_file == "1":
-        all_v_scripts, all_r_scripts = get_all_scripts_recursively_account(root_folder, verbose, last_success_build_id, current_head, access_token, buildid_info_table, snowflake_connection, autocommit, repository_id, account_level_file, pipeline_name)
-    else:
-        all_v_scripts, all_r_scripts = get_all_scripts_recursively_coedw(root_folder, verbose, last_success_build_id, current_head, access_token, buildid_info_table, snowflake_connection, autocommit, repository_id, account_level_file, pipeline_name)
-
-    try:
-
-        if len(all_v_scripts) > 0:
-            print('.....')
-            print("V Scripts modified since last build")
-            for key in range(len(all_v_scripts)):
-                print(all_v_scripts[key]['script_name'])
-        else:
-            print("There are no V Scripts modified since the last build")
-    except KeyError:
-        print(all_v_scripts)
-
+    scripts_resumed = len(all_scripts) - len(pending_scripts)
+
+    applied_checksums = None
+    if skip_unchanged:
+        applied_checksums = get_applied_checksums(snowflake_connection, change_history_table, autocommit, verbose)
+        print(f"Loaded the last deployed checksum of {len(applied_checksums)} R script(s), unchanged R scripts will be skipped")
+
+    if migrate_change_history:
+        migrate_change_history_table(snowflake_connection, change_history_table)
+        history_columns = get_change_history_columns(snowflake_connection, change_history_table)
+    missing_columns = [column for column in ChangeHistoryWriter.optional_columns if column not in history_columns]
+    if missing_columns:
+        print(f"{change_history_table['table_name']} has no {', '.join(missing_columns)} column(s), they are not recorded. Add them with --migrate-change-history")
+
+    # CHANGE_HISTORY rows are written in batches, whatever was applied is recorded even when a later script fails
+    history_writer = ChangeHistoryWriter(snowflake_connection, change_history_table, autocommit, history_batch_size, history_flush_seconds, checkpoint, history_columns, warehouse_size, current_head)
+    if checkpoint is not None:
+        checkpoint.open()
+    # Scripts the checkpoint knows as applied but CHANGE_HISTORY does not are recorded now
+    for script_path, entry in checkpointed_scripts.items():
+        if script_path not in build_applied_scripts and script_path in script_catalog:
+            history_writer.add(build_id, build_start_time, script_catalog.get(script_path), entry['checksum'], entry['execution_time'], 'Success', snowflake_connection.user, pipeline_name, entry['query_ids'])
+    apply_start = time.perf_counter()
     try:
-        if len(all_r_scripts) > 0:
-            print('.....')
-            print("R Scripts modified since last build")
-            for key in range(len(all_r_scripts)):
-                print(all_r_scripts[key]['script_name'])
+        if async_apply and async_apply > 1:
+            # Same batches as the parallel apply, submitted as asynchronous queries on the one session
+            scripts_applied, scripts_skipped = apply_change_scripts_async(snowflake_connection, pending_scripts, async_apply, vars, change_history_table, autocommit, verbose, build_id, build_start_time, pipeline_name, database_environment, applied_checksums, history_writer, stream_min_bytes, metrics, async_poll_seconds, metadata_cache)
+        elif parallel and parallel > 1:
+            # V scripts keep their strict order, R scripts of the same tier are applied concurrently
+            scripts_applied, scripts_skipped = apply_change_scripts_parallel(snowflake_connection, pending_scripts, parallel, vars, change_history_table, autocommit, verbose, build_id, build_start_time, pipeline_name, database_environment, applied_checksums, history_writer, stream_min_bytes, connection_manager, metrics, metadata_cache)
+        elif coalesce_max_kb:
+            # Consecutive small R scripts of a tier are submitted as one multi-statement query
+            scripts_applied, scripts_skipped = apply_change_scripts_coalesced(snowflake_connection, pending_scripts, int(coalesce_max_kb * 1024), coalesce_max_statements, vars, change_history_table, autocommit, verbose, build_id, build_start_time, pipeline_name, database_environment, applied_checksums, history_writer, stream_min_bytes, metrics, metadata_cache)
         else:
-            print("There are no R Scripts modified since the last build")
-    except KeyError:
-        print(all_r_scripts)
-
-    # Loop through each script in order and apply any required changes (only to versioned scripts)
-    if account_level_file == "1":
-        for script in all_v_scripts.items():
-            script_to_be_applied = script[1]
-            if apply_change_script(snowflake_connection, script_to_be_applied, vars, change_history_table, autocommit, verbose, build_id, build_start_time, pipeline_name, database_environment):
-              scripts_applied += 1
-            else:
-              scripts_skipped += 1
-              
+            # Loop through each script in order and apply any required changes
+            for script_to_be_applied in pending_scripts:
+                if apply_change_script(snowflake_connection, script_to_be_applied, vars, change_history_table, autocommit, verbose, build_id, build_start_time, pipeline_name, database_environment, applied_checksums, history_writer, stream_min_bytes, metrics, metadata_cache):
+                    scripts_applied += 1
+                else:
+                    scripts_skipped += 1
+    except BaseException:
+        # The scripts applied before the failure are still recorded. When that fails too, the error is logged and
+        # the failure of the deployment is the one raised; the checkpoint keeps the scripts for a rerun
+        try:
+            history_writer.close()
+        except Exception as error:
+            logger.error(f"Could not record the applied change scripts in {change_history_table['table_name']}: {error}")
+        # A failed run still reports where its time went
+        if metrics_file:
+            metrics.add_phase('apply', time.perf_counter() - apply_start)
+            metrics.add_phase('total', time.perf_counter() - run_start)
+            metrics.write(metrics_file, metrics_format)
+        raise
     else:
-        for i in range(len(all_v_scripts)):
-            script_to_be_applied = all_v_scripts[i]
-            if apply_change_script(snowflake_connection, script_to_be_applied, vars, change_history_table, autocommit, verbose, build_id, build_start_time, pipeline_name, database_environment):
-              scripts_applied += 1
-            else:
-              scripts_skipped += 1
+        history_writer.close()
+    finally:
+        if checkpoint is not None:
+            checkpoint.close()
+        if metadata_cache is not None:
+            metadata_cache.save()
+    metrics.add_phase('apply', time.perf_counter() - apply_start)
 
-    print(".....")
+    if predicted_seconds is not None:
+        print(f"Warehouse sizing: predicted {predicted_seconds:.0f}s, actual {time.perf_counter() - apply_start:.0f}s")
 
-    # Loop through each script in order and apply any required changes (only to non-versioned scripts)
-    for script in all_r_scripts.items():
-        script_to_be_applied = script[1]
-        if apply_change_script(snowflake_connection, script_to_be_applied, vars, change_history_table, autocommit, verbose, build_id, build_start_time, pipeline_name, database_environment):
-          scripts_applied += 1
-        else:
-          scripts_skipped += 1
+    if slowest_scripts and history_writer.query_ids_by_script:
+        with metrics.phase('query_stats'):
+            report_slowest_scripts(snowflake_connection, autocommit, verbose, history_writer.query_ids_by_script, time.perf_counter() - run_start, slowest_scripts, metrics)
+
+    print(".....")
 
-    if bool(all_r_scripts) == True or bool(all_v_scripts) == True:
+    if len(script_catalog) > 0:
         print("Doing post update task of adding build information to the DB ... ")
-        update_build_info_table(snowflake_connection, buildid_info_table, autocommit, verbose, current_head, pipeline_name, build_start_time, all_r_scripts, all_v_scripts)
+        with metrics.phase('build_info'):
+            update_build_info_table(snowflake_connection, buildid_info_table, autocommit, verbose, current_head, pipeline_name, build_start_time, script_catalog)
+    # The build is complete, a rerun has nothing to resume
+    if checkpoint is not None:
+        checkpoint.remove()
 
     if size_changed:
-        revert_warehouse_size(
-          user=snowflake_user,
-          account=snowflake_account,
-          role="CO_ADMIN",
-          warehouse=snowflake_warehouse,
-          database=snowflake_database,
-          authenticator='snowflake',
-          password=os.environ["SNOWSQL_PWD"],
-          original_size=original_size,
-          size_changed=size_changed
-          )
+        with metrics.phase('warehouse_revert'), connection_manager.role(snowflake_connection, "CO_ADMIN"):
+            revert_warehouse_size(snowflake_connection, snowflake_warehouse, original_size, size_changed)
     else:
         print("No warehouse size change detected. Revert not required.")
 
     print("Successfully applied %d change script(s)." % (scripts_applied))
     print(f"Skipped {scripts_skipped} script(s).")
+    if resume:
+        print(f"Resumed after {scripts_resumed} script(s) applied by an earlier run of build {build_id}.")
+    print(f"Saved {get_query_executor(snowflake_connection, autocommit, verbose).round_trips_saved} USE DATABASE statement(s) of unchanged session state.")
     print("Closing Snowflake Connection")
-    snowflake_connection.close()
+    connection_manager.release(snowflake_connection)
+    if not shared_connection_manager:
+        connection_manager.close()
+
+    metrics.set_counter('scripts_applied', scripts_applied)
+    metrics.set_counter('scripts_skipped', scripts_skipped)
+    metrics.set_counter('scripts_resumed', scripts_resumed)
+    metrics.set_counter('round_trips_saved', get_query_executor(snowflake_connection, autocommit, verbose).round_trips_saved)
+    metrics.add_phase('total', time.perf_counter() - run_start)
+    print_phase_summary(metrics)
+    if metrics_file:
+        metrics.write(metrics_file, metrics_format)
     print("Completed successfully")
+    return {'scripts_applied': scripts_applied, 'scripts_skipped': scripts_skipped, 'scripts_resumed': scripts_resumed}
+
+
+class PrefixedOutput:
+    # Starts every line written with a prefix, so the output of concurrent deployments stays readable
+
+    def __init__(self, stream, prefix):
+        self.stream = stream
+        self.prefix = prefix
+        self.at_line_start = True
+
+    def write(self, text):
+        for line in text.splitlines(True):
+            self.stream.write(self.prefix + line if self.at_line_start else line)
+            self.at_line_start = line.endswith('\n')
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+
+def get_environment_file(file_name, database_environment):
+    # plan.json becomes plan_tst.json, every environment writes its own file. - stays the console
+    if file_name == '-':
+        return file_name
+    root, extension = os.path.splitext(file_name)
+    return f"{root}_{database_environment}{extension}"
+
+
+def get_environment_table(table_name, database_environment):
+    # A table given in three part notation moves to the database of the environment like the deployment does,
+    # COEDW_DEV.DEPLOY.CHANGE_HISTORY becomes COEDW_TEST.DEPLOY.CHANGE_HISTORY for tst. Shorter names stay, they
+    # are in the database of the deployment already
+    if not table_name:
+        return table_name
+    table_parts = table_name.strip().split('.')
+    if len(table_parts) != 3:
+        return table_name
+    return '.'.join([get_environment_database(env_config, table_parts[0], database_environment)] + table_parts[1:])
+
+
+def deploy_environment(deployment_arguments):
+    # Runs in a worker process of deploy_environments, failures are returned as the result of the environment
+    database_environment = deployment_arguments['database_environment']
+    stdout = sys.stdout
+    if hasattr(stdout, 'reconfigure'):
+        stdout.reconfigure(line_buffering=True)
+    sys.stdout = PrefixedOutput(stdout, f"[{database_environment}] ")
+    # Handlers inherited from the parent write to its stdout, the worker's messages get the prefix as well
+    level = logger.level or (logging.DEBUG if deployment_arguments['verbose'] else logging.INFO)
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    configure_logging(level)
+    result = {'environment': database_environment, 'database': deployment_arguments['snowflake_database'], 'status': 'Success', 'error': None}
+    start = time.perf_counter()
+    try:
+        result.update(snowchange(**deployment_arguments) or {})
+    except Exception as error:
+        print(f"Deployment failed: {error}")
+        result['status'] = 'Failed'
+        result['error'] = f"{type(error).__name__}: {error}"
+    finally:
+        for handler in logger.handlers:
+            handler.flush()
+        sys.stdout.flush()
+        sys.stdout = stdout
+    result['seconds'] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def get_largest_warehouse_size(sizes):
+    # The largest of the sizes mapped for deployments sharing one warehouse, None when none is mapped
+    sizes = [normalize_warehouse_size(size) for size in sizes if size]
+    return max(sizes, key=lambda size: warehouse_sizes.index(size) if size in warehouse_sizes else -1, default=None)
+
+
+@contextlib.contextmanager
+def shared_warehouse_size(connection_manager, warehouse, deployment_warehouse_size):
+    # Resizes the warehouse once for deployments running concurrently on it and reverts it once all of them
+    # finished. Resized per deployment, one would take the size another one set for its original size, and the
+    # first to finish would shrink the warehouse under the others
+    if not deployment_warehouse_size:
+        yield
+        return
+    session = connection_manager.acquire()
+    try:
+        with connection_manager.role(session, "CO_ADMIN"):
+            original_size, size_changed = update_warehouse_size(session, warehouse, deployment_warehouse_size)
+    finally:
+        connection_manager.release(session)
+    try:
+        yield
+    finally:
+        if size_changed:
+            session = connection_manager.acquire()
+            try:
+                with connection_manager.role(session, "CO_ADMIN"):
+                    revert_warehouse_size(session, warehouse, original_size, size_changed)
+            finally:
+                connection_manager.release(session)
+
+
+def deploy_environments(deployment_arguments, database_environments, script_catalog):
+    # One worker process per environment, each with its own login, CHANGE_HISTORY and BUILD_INFORMATION writes.
+    # The discovery and order of this run are shared, every worker renders the scripts for its own environment.
+    # The shared warehouse is resized here for all of them. A failing environment does not stop the others, the
+    # run fails once all of them finished
+    deployment_warehouse_size = None
+    if not deployment_arguments['plan_file']:
+        deployment_warehouse_size = get_largest_warehouse_size((deployment_arguments['deployment_warehouse_size_dict'] or {}).get(database_environment) for database_environment in database_environments)
+        if deployment_arguments['adaptive_warehouse_size']:
+            print("Adaptive warehouse sizing is not used for several environments, the warehouse is sized from the mapping")
+    jobs = []
+    for database_environment in database_environments:
+        arguments = dict(deployment_arguments)
+        arguments['database_environment'] = database_environment
+        arguments['snowflake_database'] = get_environment_database(env_config, deployment_arguments['snowflake_database'], database_environment)
+        # Every environment reads and writes its own CHANGE_HISTORY and BUILD_INFORMATION
+        arguments['change_history_table_override'] = get_environment_table(deployment_arguments['change_history_table_override'], database_environment)
+        arguments['build_info_table'] = get_environment_table(deployment_arguments['build_info_table'], database_environment)
+        arguments['script_catalog'] = script_catalog
+        # Workers log in themselves, a batch's shared diff and sessions stay in this process
+        arguments['change_source'] = None
+        arguments['connection_manager'] = None
+        # The catalog is already in dependency order when it was asked for
+        arguments['dependency_order'] = False
+        arguments['deployment_warehouse_size_dict'] = None
+        arguments['adaptive_warehouse_size'] = False
+        for file_argument in ('plan_file', 'metrics_file', 'checkpoint_file'):
+            if arguments[file_argument]:
+                arguments[file_argument] = get_environment_file(arguments[file_argument], database_environment)
+        jobs.append(arguments)
+
+    print(".....")
+    print(f"Deploying {len(script_catalog)} script(s) to {len(jobs)} environment(s) concurrently: {', '.join(job['database_environment'] + ' (' + job['snowflake_database'] + ')' for job in jobs)}")
+    connection_manager = None
+    if deployment_warehouse_size:
+        connection_manager = SnowflakeConnectionManager(deployment_arguments['snowflake_account'], deployment_arguments['snowflake_user'], deployment_arguments['snowflake_role'], deployment_arguments['snowflake_warehouse'], deployment_arguments['snowflake_database'], os.environ["SNOWSQL_PWD"], deployment_arguments['autocommit'], deployment_arguments['verbose'])
+    try:
+        with shared_warehouse_size(connection_manager, deployment_arguments['snowflake_warehouse'], deployment_warehouse_size):
+            # Buffered output would otherwise be written again by every worker
+            for handler in logger.handlers:
+                handler.flush()
+            sys.stdout.flush()
+            with ProcessPoolExecutor(max_workers=len(jobs)) as executor:
+                results = list(executor.map(deploy_environment, jobs))
+    finally:
+        if connection_manager is not None:
+            connection_manager.close()
+
+    print(".....")
+    print("Result per environment")
+    for result in results:
+        print(f"{result['environment']:<10} {result['database']:<28} {result['status']:<8} applied {result.get('scripts_applied', 0)}, skipped {result.get('scripts_skipped', 0)} in {result['seconds']:.1f}s" + (f" - {result['error']}" if result['error'] else ""))
+    failed = [result['environment'] for result in results if result['status'] != 'Success']
+    if failed:
+        raise ValueError(f"Deployment failed in environment(s) {', '.join(failed)}")
+    return results
+
+
+class ThreadPrefixedOutput:
+    # Like PrefixedOutput for the threads of a batch, every thread has its own prefix. Lines are written whole,
+    # so the lines of concurrent jobs do not mix
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def set_prefix(self, prefix):
+        self.local.prefix = prefix
+        self.local.pending = ''
+
+    def write(self, text):
+        prefix = getattr(self.local, 'prefix', None)
+        if prefix is None:
+            with self.lock:
+                self.stream.write(text)
+            return len(text)
+        lines = (self.local.pending + text).split('\n')
+        self.local.pending = lines.pop()
+        if lines:
+            with self.lock:
+                self.stream.write(''.join(prefix + line + '\n' for line in lines))
+        return len(text)
+
+    def flush(self):
+        pending = getattr(self.local, 'pending', '')
+        if pending:
+            self.local.pending = ''
+            with self.lock:
+                self.stream.write(self.local.prefix + pending + '\n')
+        self.stream.flush()
+
+
+def load_batch_manifest(manifest_file):
+    # A JSON list of jobs, or {"jobs": [...]}. Every job is a dict of snowchange() arguments, root_folder,
+    # snowflake_database and pipeline_name are required, the other arguments default to the command line ones
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+    jobs = manifest['jobs'] if isinstance(manifest, dict) else manifest
+    parameters = inspect.signature(snowchange).parameters
+    for number, job in enumerate(jobs, start=1):
+        missing = [key for key in ('root_folder', 'snowflake_database', 'pipeline_name') if not job.get(key)]
+        if missing:
+            raise ValueError(f"Job {number} of {manifest_file} is missing {', '.join(missing)}")
+        unknown = [key for key in job if key not in parameters or key in ('script_catalog', 'change_source', 'connection_manager')]
+        if unknown:
+            raise ValueError(f"Job {number} of {manifest_file} has unknown argument(s) {', '.join(unknown)}")
+        job.setdefault('account_level_file', '0')
+    return jobs
+
+
+def run_batch(manifest_file, deployment_arguments, max_workers=None, report_file=None):
+    # Runs the jobs of a manifest in this one process. The diff of a commit range is fetched once for all jobs of
+    # a repository, jobs with the same account, user, role and warehouse share their logins, and jobs of different
+    # databases run concurrently while the jobs of one database keep their manifest order. A failed job skips the
+    # later jobs of its database, the other databases carry on. Every warehouse is resized once for the whole batch
+    jobs = load_batch_manifest(manifest_file)
+    batch_start = time.perf_counter()
+    job_groups = dict()
+    for number, job in enumerate(jobs, start=1):
+        arguments = dict(deployment_arguments)
+        arguments.update(job)
+        if arguments.get('plan_file') == '-' and len(jobs) > 1:
+            raise ValueError("The plans of a batch cannot be written to the console, give a file name for --plan")
+        # Several environments fork worker processes, which is not safe from the threads of a batch. The locks of
+        # the other jobs' output, logging, sessions and shared diff could be held by the forked copy for good
+        if isinstance(arguments['database_environment'], (list, tuple)):
+            environments = list(dict.fromkeys(arguments['database_environment']))
+            if len(environments) > 1:
+                raise ValueError(f"Job {number} of {manifest_file} deploys to {len(environments)} environments, give every environment a job of its own in a batch")
+            arguments['database_environment'] = environments[0] if environments else None
+        # Every job needs files of its own, the command line ones are numbered per job
+        for file_argument in ('plan_file', 'metrics_file', 'checkpoint_file'):
+            if arguments.get(file_argument) and file_argument not in job:
+                arguments[file_argument] = get_environment_file(arguments[file_argument], f"job{number}")
+        job_groups.setdefault(arguments['snowflake_database'].upper(), []).append((number, arguments))
+    print(f"Batch of {len(jobs)} job(s) on {len(job_groups)} database(s) from {manifest_file}")
+
+    lock = threading.Lock()
+    change_sources = dict()
+    connection_managers = dict()
+
+    def get_change_source(arguments):
+        if arguments.get('change_source_type') == 'git':
+            key = ('git', os.path.abspath(arguments['root_folder']), tuple(arguments.get('change_source_paths') or ()))
+        else:
+            key = ('rest', arguments['repository_id'])
+        with lock:
+            if key not in change_sources:
+                if key[0] == 'git':
+                    change_source = GitChangeSource(os.path.abspath(arguments['root_folder']), arguments.get('change_source_paths'))
+                else:
+                    change_source = AzureDevOpsDiffClient(arguments['access_token'], arguments['repository_id'], base_url=arguments.get('azure_devops_url') or azure_devops_base_url, cache_dir=arguments.get('diff_cache_dir'), max_workers=arguments.get('diff_max_workers') or 4)
+                change_sources[key] = SharedChangeSource(change_source)
+            return change_sources[key]
+
+    def get_connection_manager(arguments):
+        key = (arguments['snowflake_account'], arguments['snowflake_user'], arguments['snowflake_role'].upper(), arguments['snowflake_warehouse'], arguments['autocommit'])
+        with lock:
+            if key not in connection_managers:
+                connection_managers[key] = SnowflakeConnectionManager(arguments['snowflake_account'], arguments['snowflake_user'], arguments['snowflake_role'], arguments['snowflake_warehouse'], arguments['snowflake_database'], os.environ.get("SNOWSQL_PWD"), arguments['autocommit'], arguments['verbose'])
+            return connection_managers[key]
+
+    def run_jobs(group):
+        results = []
+        failed_job = None
+        for number, arguments in group:
+            result = {'job': number, 'root_folder': arguments['root_folder'], 'database': arguments['snowflake_database'], 'pipeline_name': arguments['pipeline_name'], 'status': 'Success', 'error': None, 'seconds': 0}
+            results.append(result)
+            if failed_job is not None:
+                result['status'] = 'Skipped'
+                result['error'] = f"job {failed_job} of the same database failed"
+                continue
+            output.set_prefix(f"[{number}:{arguments['pipeline_name']}] ")
+            start = time.perf_counter()
+            try:
+                arguments['change_source'] = get_change_source(arguments)
+                arguments['connection_manager'] = get_connection_manager(arguments)
+                outcome = snowchange(**arguments)
+                if isinstance(outcome, dict) and 'scripts_applied' in outcome:
+                    result.update(outcome)
+            except Exception as error:
+                print(f"Job failed: {error}")
+                result['status'] = 'Failed'
+                result['error'] = f"{type(error).__name__}: {error}"
+                failed_job = number
+            finally:
+                sys.stdout.flush()
+                output.set_prefix(None)
+            result['seconds'] = round(time.perf_counter() - start, 3)
+        return results
+
+    # Jobs of different databases run on the same warehouse concurrently, it gets the largest size any of them maps
+    # to before the first job starts and its size back after the last one finished
+    warehouse_jobs = dict()
+    for number, arguments in sorted((job for group in job_groups.values() for job in group), key=lambda job: job[0]):
+        sizes = warehouse_jobs.setdefault((arguments['snowflake_account'], arguments['snowflake_warehouse'].upper()), (arguments, []))[1]
+        if not arguments.get('plan_file'):
+            sizes.append((arguments.get('deployment_warehouse_size_dict') or {}).get(arguments['database_environment']))
+        if arguments.get('adaptive_warehouse_size'):
+            print(f"Adaptive warehouse sizing is not used in a batch, job {number} runs on the size from the mapping")
+        arguments['deployment_warehouse_size_dict'] = None
+        arguments['adaptive_warehouse_size'] = False
+
+    stdout = sys.stdout
+    output = ThreadPrefixedOutput(stdout)
+    try:
+        with contextlib.ExitStack() as resized_warehouses:
+            for arguments, sizes in warehouse_jobs.values():
+                resized_warehouses.enter_context(shared_warehouse_size(get_connection_manager(arguments), arguments['snowflake_warehouse'], get_largest_warehouse_size(sizes)))
+            sys.stdout = output
+            try:
+                with ThreadPoolExecutor(max_workers=max(1, min(max_workers or len(job_groups), len(job_groups)))) as executor:
+                    results = sorted((result for group_results in executor.map(run_jobs, job_groups.values()) for result in group_results), key=lambda result: result['job'])
+            finally:
+                sys.stdout = stdout
+    finally:
+        for change_source in change_sources.values():
+            change_source.close_shared()
+        for connection_manager in connection_managers.values():
+            connection_manager.close()
+
+    print(".....")
+    print("Batch result")
+    for result in results:
+        print(f"{result['job']:>3} {result['pipeline_name']:<32} {result['database']:<24} {result['status']:<8} applied {result.get('scripts_applied', 0)}, skipped {result.get('scripts_skipped', 0)} in {result['seconds']:.1f}s" + (f" - {result['error']}" if result['error'] else ""))
+    report = {
+        'manifest': manifest_file,
+        'seconds': round(time.perf_counter() - batch_start, 3),
+        'jobs': results,
+        'succeeded': sum(1 for result in results if result['status'] == 'Success'),
+        'failed': sum(1 for result in results if result['status'] == 'Failed'),
+        'skipped': sum(1 for result in results if result['status'] == 'Skipped')
+    }
+    print(f"{report['succeeded']} job(s) succeeded, {report['failed']} failed, {report['skipped']} skipped in {report['seconds']:.1f}s")
+    if report_file:
+        with open(report_file, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Batch report written to {report_file}")
+    if report['failed']:
+        raise ValueError(f"{report['failed']} job(s) of the batch failed")
+    return report
+
+
+def report_slowest_scripts(snowflake_connection, autocommit, verbose, query_ids_by_script, run_seconds, top, metrics=None):
+    # Server side time of the scripts of this run, from one QUERY_HISTORY query. The deployment already succeeded,
+    # so a failure here is only reported
+    try:
+        query_stats = get_query_stats(snowflake_connection, autocommit, verbose, [query_id for query_ids in query_ids_by_script.values() for query_id in query_ids], run_seconds, execute_snowflake_query)
+    except Exception as e:
+        print(f"Could not load the query statistics of the deployed scripts: {e}")
+        return
+    script_stats = summarize_query_stats(query_ids_by_script, query_stats)
+    if metrics is not None:
+        metrics.slowest_scripts = script_stats[:top]
+    print(".....")
+    print(f"Slowest scripts ({len(query_stats)} of {sum(len(query_ids) for query_ids in query_ids_by_script.values())} queries found in QUERY_HISTORY)")
+    for stats in script_stats[:top]:
+        print(f"{stats['elapsed_seconds']:9.3f}s  queued {stats['queued_seconds']:.3f}s  compile {stats['compilation_seconds']:.3f}s  execute {stats['execution_seconds']:.3f}s  scanned {stats['bytes_scanned']} bytes  {stats['script']}")
 
 
-def get_all_scripts_recursively_coedw(root_directory, verbose, last_success_build_id, current_head, access_token, buildid_info_table, snowflake_connection, autocommit, repository_id, account_level_file, pipeline_name):
+def print_phase_summary(metrics):
+    print(".....")
+    print("Time per phase")
+    for name, phase in metrics.report()['phases'].items():
+        print(f"{name}: {phase['seconds']:.3f}s" + (f" ({phase['count']} times)" if phase['count'] > 1 else ""))
+
+
+def configure_logging(level):
+    # Detail messages are buffered and written in blocks, an error flushes them immediately
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+    buffered_handler = logging.handlers.MemoryHandler(capacity=1000, flushLevel=logging.ERROR, target=stream_handler)
+    logger.addHandler(buffered_handler)
+    logger.setLevel(level)
+    logger.propagate = False
+
+
+def get_all_scripts_recursively_coedw(root_directory, verbose, last_success_build_id, current_head, access_token, buildid_info_table, snowflake_connection, autocommit, repository_id, account_level_file, pipeline_name, orderfile=orderfile, order_root_depth=9, change_source=None, metadata_cache=None):
     return get_modified_files(
       current_head=current_head,
       snowflake_connection=snowflake_connection,
@@ -213,11 +866,14 @@ def get_all_scripts_recursively_coedw(root_directory, verbose, last_success_buil
       repository_id=repository_id,
       folder_path='/coEDW/',
       account_level_file=account_level_file,
-      pipeline_name=pipeline_name
+      pipeline_name=pipeline_name,
+      root_depth=order_root_depth,
+      change_source=change_source,
+      metadata_cache=metadata_cache
       )
 
 
-def get_all_scripts_recursively_account(root_directory, verbose, last_success_build_id, current_head, access_token, buildid_info_table, snowflake_connection, autocommit, repository_id, pipeline_name):
+def get_all_scripts_recursively_account(root_directory, verbose, last_success_build_id, current_head, access_token, buildid_info_table, snowflake_connection, autocommit, repository_id, pipeline_name, change_source=None, metadata_cache=None):
     return get_account_modified_files(
           current_head=current_head,
           snowflake_connection=snowflake_connection,
@@ -229,14 +885,16 @@ def get_all_scripts_recursively_account(root_directory, verbose, last_success_bu
           access_token=access_token,
           last_success_build_id=last_success_build_id,
           repository_id=repository_id,
-          pipeline_name=pipeline_name
+          pipeline_name=pipeline_name,
+          change_source=change_source,
+          metadata_cache=metadata_cache
       )
 
 
-def get_build_information_table_details(build_info_table):
+def get_build_information_table_details(build_info_table, snowflake_database):
     # Start with the global defaults
     build_details = dict()
-    build_details['database_name'] = os.environ["SNOWFLAKE_DATABASE"]
+    build_details['database_name'] = snowflake_database
     build_details['schema_name'] = _metadata_schema_name.upper()
     build_details['buildinfo_table_name'] = _metadata_buildinfo_table_name.upper()
 
@@ -258,38 +916,195 @@ def get_build_information_table_details(build_info_table):
     return build_details
 
 
-def execute_snowflake_query(snowflake_connection, query, autocommit, verbose):
-
-  external_stage = env_stage_list['COEDW_DEV']
-  external_stage_rpl = external_stage
-  db = os.environ.get("SNOWFLAKE_DATABASE")
+class SnowflakeQueryExecutor:
+    # Owns a connection and tracks its session state (database, schema, warehouse, autocommit), so USE statements
+    # and autocommit changes are only sent when the wanted state differs. round_trips_saved counts the skipped USE
+    # DATABASE statements, earlier versions sent one before every query.
+    # last_query_ids holds the Snowflake query IDs of the statements of the last execute, USE statements excluded.
+
+    # Statements after which the session state is no longer known: USE itself, CREATE DATABASE/SCHEMA (which switch
+    # to the new object) and CALL (procedures running with caller's rights may switch)
+    state_changing_pattern = re.compile(r'\bUSE\s|\bCREATE\s+(?:OR\s+REPLACE\s+)?(?:TRANSIENT\s+)?(?:DATABASE|SCHEMA)\b|\bCALL\s', re.IGNORECASE)
+
+    # Streamed scripts can run millions of statements, only the first ones are kept
+    max_query_ids = 1000
+
+    def __init__(self, snowflake_connection, database, autocommit, verbose=False, warehouse=None, schema=None):
+        self.snowflake_connection = snowflake_connection
+        self.database = database
+        self.schema = schema
+        self.warehouse = warehouse
+        self.autocommit = autocommit
+        self.verbose = verbose
+        # The connection was opened with the database and warehouse, the first query does not switch to them again
+        self.session_state = {object_type: name.upper() for object_type, name in (('DATABASE', database), ('SCHEMA', schema), ('WAREHOUSE', warehouse)) if name}
+        self.autocommit_state = None
+        self.round_trips_saved = 0
+        self.last_query_ids = []
+
+        # The stage replacement only depends on the database, work it out once
+        self.external_stage = env_stage_list[env_config['stage_source_database']]
+        self.external_stage_rpl = env_stage_list.get(database, self.external_stage)
+
+    def set_database(self, database, schema=None):
+        # The next query switches the session to the database and schema, the stage replacement follows it
+        self.database = database
+        self.schema = schema
+        self.external_stage_rpl = env_stage_list.get(database, self.external_stage)
+
+    def use(self, object_type, name):
+        if not name:
+            return
+        if self.session_state.get(object_type) == name.upper():
+            if object_type == 'DATABASE':
+                self.round_trips_saved += 1
+            return
+        self.snowflake_connection.execute_string(f"USE {object_type} {name}")
+        self.session_state[object_type] = name.upper()
+        if object_type == 'DATABASE':
+            # Switching the database also switches the schema
+            self.session_state.pop('SCHEMA', None)
+
+    def set_autocommit(self, autocommit):
+        if self.autocommit_state == autocommit:
+            return
+        self.snowflake_connection.autocommit(autocommit)
+        self.autocommit_state = autocommit
+
+    def forget_session_state(self):
+        self.session_state = dict()
+
+    def use_session_state(self):
+        # The schema is switched after the database, switching the database resets it
+        self.use('DATABASE', self.database)
+        self.use('SCHEMA', self.schema)
+        self.use('WAREHOUSE', self.warehouse)
+
+    def replace_stage(self, query):
+        if self.external_stage in query and self.external_stage_rpl != self.external_stage:
+            logger.debug(f"execute_snowflake_query()- The db is: {self.database}, replacing  {self.external_stage} in query with {self.external_stage_rpl}")
+            query = query.replace(self.external_stage, self.external_stage_rpl)
+            logger.debug(f"execute_snowflake_query()- replaced query with : {self.external_stage_rpl}")
+        return query
+
+    def execute(self, query, replace_stage=True):
+        if replace_stage:
+            query = self.replace_stage(query)
+
+        if not self.autocommit:
+            self.set_autocommit(False)
+
+        self.last_query_ids = []
+        try:
+            self.use_session_state()
+            res = self.snowflake_connection.execute_string(query)
+            self.last_query_ids = [cursor.sfqid for cursor in res[:self.max_query_ids] if cursor.sfqid]
+            if not self.autocommit:
+                self.snowflake_connection.commit()
+            if self.state_changing_pattern.search(query):
+                self.forget_session_state()
+            return res
+        except Exception as e:
+            # A failed statement may have changed the session halfway
+            self.forget_session_state()
+            if not self.autocommit:
+                self.snowflake_connection.rollback()
+            raise e
+
+    def execute_multi_statement(self, query, statement_count, replace_stage=True):
+        # Submits the statements of the query as one multi-statement query, a single round trip however many
+        # statements there are. Snowflake stops at the first failing statement. Returns the cursor
+        if replace_stage:
+            query = self.replace_stage(query)
+
+        if not self.autocommit:
+            self.set_autocommit(False)
+
+        self.last_query_ids = []
+        cursor = self.snowflake_connection.cursor()
+        try:
+            self.use_session_state()
+            cursor.execute(query, num_statements=statement_count)
+            # Every statement runs as a query of its own. Their IDs come with the result, going through the results
+            # with nextset() would fetch each of them in another round trip
+            self.last_query_ids = list(cursor.multi_statement_savedIds or [])[:self.max_query_ids]
+            if not self.autocommit:
+                self.snowflake_connection.commit()
+            if self.state_changing_pattern.search(query):
+                self.forget_session_state()
+            return cursor
+        except Exception as e:
+            self.forget_session_state()
+            if not self.autocommit:
+                self.snowflake_connection.rollback()
+            raise e
+        finally:
+            cursor.close()
+
+    def execute_statements(self, statements, replace_stage=True):
+        # Executes statements one at a time as they are produced, each cursor is closed as soon as its statement
+        # is done so results of earlier statements are not held. Returns the number of statements executed
+        if not self.autocommit:
+            self.set_autocommit(False)
+
+        statement_count = 0
+        self.last_query_ids = []
+        try:
+            self.use_session_state()
+            for statement in statements:
+                if not is_executable_statement(statement):
+                    continue
+                statement = statement.strip()
+                statement = statement[:-1] if statement.endswith(';') else statement
+                if replace_stage:
+                    statement = self.replace_stage(statement)
+                cursor = self.snowflake_connection.cursor()
+                try:
+                    cursor.execute(statement)
+                    if cursor.sfqid and len(self.last_query_ids) < self.max_query_ids:
+                        self.last_query_ids.append(cursor.sfqid)
+                finally:
+                    cursor.close()
+                statement_count += 1
+                if self.state_changing_pattern.search(statement):
+                    self.forget_session_state()
+            if not self.autocommit:
+                self.snowflake_connection.commit()
+            return statement_count
+        except Exception as e:
+            self.forget_session_state()
+            if not self.autocommit:
+                self.snowflake_connection.rollback()
+            raise e
+
+
+# One executor per connection, registered when the connection is opened or created the first time a query runs on it
+_query_executors = weakref.WeakKeyDictionary()
+_query_executors_lock = threading.Lock()
+
+
+def register_query_executor(snowflake_connection, executor):
+    with _query_executors_lock:
+        _query_executors[snowflake_connection] = executor
+
+
+def get_query_executor(snowflake_connection, autocommit, verbose=False):
+    with _query_executors_lock:
+        executor = _query_executors.get(snowflake_connection)
+        if executor is None:
+            executor = SnowflakeQueryExecutor(snowflake_connection, getattr(snowflake_connection, 'database', None), autocommit, verbose, getattr(snowflake_connection, 'warehouse', None), getattr(snowflake_connection, 'schema', None))
+            _query_executors[snowflake_connection] = executor
+        return executor
 
-  if db and db in env_stage_list:
-    external_stage_rpl = env_stage_list[db]
 
-  if external_stage in query and external_stage_rpl:
-    print(f"execute_snowflake_query()- The db is: {db}, replacing  {external_stage} in query with {external_stage_rpl}")
-    query = query.replace(external_stage, external_stage_rpl)
-    print(f"execute_snowflake_query()- replaced query with : {external_stage_rpl}")
+def execute_snowflake_query(snowflake_connection, query, autocommit, verbose):
+  return get_query_executor(snowflake_connection, autocommit, verbose).execute(query)
 
-  if not autocommit:
-    snowflake_connection.autocommit(False)
 
-  try:
-    snowflake_connection.execute_string(f"USE DATABASE {db}")
-    res = snowflake_connection.execute_string(query)
-    if not autocommit:
-      snowflake_connection.commit()
-    return res
-  except Exception as e:
-    if not autocommit:
-      snowflake_connection.rollback()
-    raise e
-
-def get_change_history_table_details(change_history_table_override):
+def get_change_history_table_details(change_history_table_override, snowflake_database):
   # Start with the global defaults
   details = dict()
-  details['database_name'] = os.environ["SNOWFLAKE_DATABASE"]
+  details['database_name'] = snowflake_database
   details['schema_name'] = _metadata_schema_name.upper()
   details['table_name'] = _metadata_table_name.upper()
 
@@ -312,139 +1127,769 @@ def get_change_history_table_details(change_history_table_override):
   return details
 
 
-def execute_and_record_change(snowflake_connection, script, vars, change_history_table, autocommit, verbose, build_id, build_start_time, pipeline_name, database_environment):
+def get_change_history_columns(snowflake_connection, change_history_table):
+  # Names of the columns the change history table has
+  cursor = snowflake_connection.cursor()
+  try:
+    cursor.execute("SHOW COLUMNS IN TABLE {0}.{1}.{2}".format(change_history_table['database_name'], change_history_table['schema_name'], change_history_table['table_name']))
+    return {row[2].upper() for row in cursor.fetchall()}
+  finally:
+    cursor.close()
 
-  # First read the contents of the script
-  with open(script['script_full_path'],'r') as content_file:
-    filename = script['script_full_path'].split('/')[-1]  # Extract the filename from the full path
+
+def migrate_change_history_table(snowflake_connection, change_history_table):
+  # Adds the columns of later versions to an existing change history table. Only run on request, with a role
+  # allowed to alter the table, deployments write whatever columns the table has
+  cursor = snowflake_connection.cursor()
+  try:
+    for column, column_type in ChangeHistoryWriter.optional_columns.items():
+      cursor.execute("ALTER TABLE {0}.{1}.{2} ADD COLUMN IF NOT EXISTS {3} {4}".format(change_history_table['database_name'], change_history_table['schema_name'], change_history_table['table_name'], column, column_type))
+  finally:
+    cursor.close()
+  print(f"Added the column(s) {', '.join(ChangeHistoryWriter.optional_columns)} to {change_history_table['table_name']} where missing")
+
+
+class ChangeHistoryWriter:
+    # Buffers CHANGE_HISTORY rows and writes them as one multi-row insert with bound parameters, once max_rows
+    # rows are waiting or the oldest one waited max_seconds. With autocommit a timer writes them after max_seconds
+    # also while a long script is running; in a transaction the insert would commit the running script, there the
+    # age is only checked when a row is added. close() must be called at the end of the run.
+    # Columns later versions added to the table, like QUERY_IDS, are only written when the table has them.
+    # EXECUTION_TIME is a whole number of seconds, the milliseconds go to EXECUTION_MS.
+    # Successful scripts are also written to the checkpoint right away, the rows may wait for the next flush.
+
+    row_values = "(%s, to_timestamp_ntz(%s, 'yyyymmddhh24miss'), %s, %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP, %s, %s"
+
+    # Added by migrate_change_history_table, with their type
+    optional_columns = {'QUERY_IDS': 'VARCHAR', 'EXECUTION_MS': 'NUMBER', 'WAREHOUSE_SIZE': 'VARCHAR', 'COMMIT_ID': 'VARCHAR'}
+
+    def __init__(self, snowflake_connection, change_history_table, autocommit, max_rows=50, max_seconds=30, checkpoint=None, columns=None, warehouse_size=None, commit_id=None):
+        self.snowflake_connection = snowflake_connection
+        self.change_history_table = change_history_table
+        self.autocommit = autocommit
+        self.max_rows = max(max_rows, 1)
+        self.max_seconds = max_seconds
+        self.lock = threading.Lock()
+        self.rows = []
+        self.oldest_row_time = None
+        self.timer = None
+        self.query_ids_by_script = dict()
+        self.checkpoint = checkpoint
+        # Column names of the table, looked up on the first flush when they are not given
+        self.columns = columns
+        # Size of the warehouse the scripts run at
+        self.warehouse_size = normalize_warehouse_size(warehouse_size) if warehouse_size else None
+        # Commit the scripts were deployed from, a resumed build only skips the scripts applied from it
+        self.commit_id = commit_id
+
+    def add(self, build_id, build_start_time, script, checksum, execution_time, status, installed_by, pipeline_name, query_ids=None):
+        with self.lock:
+            if not self.rows:
+                self.oldest_row_time = time.time()
+            if query_ids:
+                self.query_ids_by_script[script.script_full_path] = list(query_ids)
+            self.rows.append(((build_id, build_start_time, script.script_description, script.script_name, script.script_type, checksum, round(execution_time), status, installed_by, script.script_full_path, pipeline_name), {'QUERY_IDS': ','.join(query_ids) if query_ids else None, 'EXECUTION_MS': round(execution_time * 1000), 'WAREHOUSE_SIZE': self.warehouse_size, 'COMMIT_ID': self.commit_id}))
+            flush_due = len(self.rows) >= self.max_rows or time.time() - self.oldest_row_time >= self.max_seconds
+            if not flush_due and self.timer is None and self.autocommit:
+                self.timer = threading.Timer(self.max_seconds - (time.time() - self.oldest_row_time), self.flush_on_timer)
+                self.timer.daemon = True
+                self.timer.start()
+        if self.checkpoint is not None and status == 'Success':
+            self.checkpoint.record(script.script_full_path, checksum, execution_time, query_ids)
+        if flush_due:
+            self.flush()
+
+    def flush_on_timer(self):
+        # The rows stay buffered when the insert fails, the next flush tries again
+        try:
+            self.flush()
+        except Exception as error:
+            logger.warning(f"Could not record change scripts in {self.change_history_table['table_name']}, retrying with the next batch: {error}")
+
+    def flush(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if not self.rows:
+                return
+            if self.columns is None:
+                self.columns = get_change_history_columns(self.snowflake_connection, self.change_history_table)
+            optional_columns = [column for column in self.optional_columns if column in self.columns]
+            query = """INSERT INTO {0}.{1}.{2} (BUILD_ID, BUILD_START_TIME, DESCRIPTION, SCRIPT, SCRIPT_TYPE, CHECKSUM, EXECUTION_TIME, STATUS, INSTALLED_BY, INSTALLED_ON, SCRIPT_PATH, PIPELINE_NAME{3})
+                       values {4}""".format(self.change_history_table['database_name'], self.change_history_table['schema_name'], self.change_history_table['table_name'], ''.join(', ' + column for column in optional_columns), ', '.join([self.row_values + ', %s' * len(optional_columns) + ')'] * len(self.rows)))
+            params = [value for values, optional_values in self.rows for value in values + tuple(optional_values[column] for column in optional_columns)]
+            cursor = self.snowflake_connection.cursor()
+            try:
+                cursor.execute(query, params)
+                if not self.autocommit:
+                    self.snowflake_connection.commit()
+            finally:
+                cursor.close()
+            print(f"Recorded {len(self.rows)} change script(s) in {self.change_history_table['table_name']}")
+            self.rows = []
+
+    def close(self):
+        self.flush()
+
+
+def timed_phase(metrics, name):
+  # The phase timer of the run, or nothing when the caller does not collect metrics
+  return metrics.phase(name) if metrics is not None else contextlib.nullcontext()
+
+
+def read_change_script(script, database_environment, metrics=None):
+  # Read the contents of the script as they will be executed in this environment
+  with timed_phase(metrics, 'script_read'), open(script.script_full_path,'r') as content_file:
+    filename = script.script_full_path.split('/')[-1]  # Extract the filename from the full path
     content = content_file.read().strip()
     content = content[:-1] if content.endswith(';') else content
-    if filename not in exclude_files:
+  if filename not in exclude_files:
+    with timed_phase(metrics, 'script_rewrite'):
       content = replace_env(content,database_environment)
- 
-  # Define a few other change related variables
-  checksum = hashlib.sha224(content.encode('utf-8')).hexdigest()
+  return content
+
+
+def stream_change_script(script, database_environment, hasher, chunk_size=1048576):
+  # The statements of the script rendered as read_change_script renders the whole file, produced while the file is
+  # read in chunks. The hasher is fed the rendered content, so it ends with the checksum of read_change_script
+  filename = script.script_full_path.split('/')[-1]
+  messages = dict()
+  with open(script.script_full_path,'r') as content_file:
+    chunks = iter(lambda: content_file.read(chunk_size), '')
+    # The last statement and any whitespace after it are held back, the end of the file is stripped like read_change_script does
+    pending = ""
+    for statement in split_sql_statements(chunks):
+      if not pending and not statement.strip():
+        continue
+      if not pending:
+        statement = statement.lstrip()
+      elif statement.strip():
+        yield render_statement(pending, filename, database_environment, hasher, messages)
+        pending = ""
+      pending += statement
+    pending = pending.rstrip()
+    pending = pending[:-1] if pending.endswith(';') else pending
+    if pending:
+      yield render_statement(pending, filename, database_environment, hasher, messages)
+  for message in messages:
+    logger.debug(message)
+
+
+def render_statement(statement, filename, database_environment, hasher, messages):
+  if filename not in exclude_files:
+    statement = replace_env(statement, database_environment, messages)
+  hasher.update(statement.encode('utf-8'))
+  return statement
+
+
+def report_progress(statements, script_path, interval=1000):
+  # Passes the statements through, printing how far a streamed script has got
+  for statement_count, statement in enumerate(statements, 1):
+    yield statement
+    if statement_count % interval == 0:
+      print(f"Read {statement_count} statement(s) of {script_path}")
+
+
+def get_applied_checksums(snowflake_connection, change_history_table, autocommit, verbose):
+  # Latest successful checksum of every R script, loaded once so unchanged scripts can be skipped without a query each
+  query = """SELECT SCRIPT_PATH, CHECKSUM FROM {0}.{1}.{2} WHERE SCRIPT_TYPE = 'R' AND STATUS = 'Success'
+             QUALIFY ROW_NUMBER() OVER (PARTITION BY SCRIPT_PATH ORDER BY INSTALLED_ON DESC) = 1;""".format(change_history_table['database_name'], change_history_table['schema_name'], change_history_table['table_name'])
+  resultset = execute_snowflake_query(snowflake_connection, query, autocommit, verbose)
+  return dict(resultset[0].fetchall())
+
+
+def get_build_applied_scripts(snowflake_connection, change_history_table, autocommit, verbose, build_id, pipeline_name, current_head=None, columns=()):
+  # Checksum of every script an earlier run of this build and pipeline applied successfully, in one query. Where
+  # COMMIT_ID was recorded, only the runs of the same commit count
+  commit_filter = " AND (COMMIT_ID = '{0}' OR COMMIT_ID IS NULL)".format(str(current_head).replace("'", "''")) if current_head and 'COMMIT_ID' in columns else ""
+  query = """SELECT SCRIPT_PATH, CHECKSUM FROM {0}.{1}.{2} WHERE BUILD_ID = '{3}' AND PIPELINE_NAME = '{4}' AND STATUS = 'Success'{5};""".format(change_history_table['database_name'], change_history_table['schema_name'], change_history_table['table_name'], str(build_id).replace("'", "''"), str(pipeline_name).replace("'", "''"), commit_filter)
+  resultset = execute_snowflake_query(snowflake_connection, query, autocommit, verbose)
+  return dict(resultset[0].fetchall())
+
+
+def get_resumed_scripts(scripts, applied_script_paths, database_environment):
+  # The scripts from the first one of this environment that was not applied yet, in their original order. Scripts
+  # after it that were applied anyway, like the finished ones of an interrupted concurrent tier, are left out too
+  resume_position = next((position for position, script in enumerate(scripts) if script.script_full_path not in applied_script_paths and is_script_for_environment(script, database_environment)), len(scripts))
+  pending_scripts = [script for script in scripts[resume_position:] if script.script_full_path not in applied_script_paths]
+  if resume_position < len(scripts):
+    print(f"Resuming at change script {scripts[resume_position].script_full_path} ({resume_position + 1} of {len(scripts)}), {len(scripts) - len(pending_scripts)} script(s) need not run again")
+  else:
+    print(f"All {len(scripts)} change script(s) were already applied by this build")
+  return pending_scripts
+
+
+def execute_and_record_change(snowflake_connection, script, vars, change_history_table, autocommit, verbose, build_id, build_start_time, pipeline_name, database_environment, applied_checksums=None, history_writer=None, stream_min_bytes=None, metrics=None, metadata_cache=None):
+  script_start = time.perf_counter()
+
+  # Scripts from stream_min_bytes up are read, rendered and executed statement by statement instead of as one string
+  streaming = stream_min_bytes is not None and os.path.getsize(script.script_full_path) >= stream_min_bytes
+
+  # A checksum cached for the file as it is now decides about unchanged R scripts without reading them
+  checksum = metadata_cache.get_checksum(script.script_full_path, database_environment) if metadata_cache is not None else None
+  content = None
+
+  # First read the contents of the script
+  if streaming:
+    if checksum is None and applied_checksums is not None and script.script_type == 'R':
+      # The checksum is needed before executing, take it in a separate pass over the file
+      checksum = get_script_checksum(script, database_environment, stream_min_bytes, metadata_cache)
+  elif checksum is None or applied_checksums is None or applied_checksums.get(script.script_full_path) != checksum:
+    content = read_change_script(script, database_environment, metrics)
+
+    # Define a few other change related variables
+    checksum = hashlib.sha224(content.encode('utf-8')).hexdigest()
+    if metadata_cache is not None:
+      metadata_cache.put_checksum(script.script_full_path, database_environment, checksum)
+
+  # R scripts whose rendered content was already deployed are not executed again
+  if applied_checksums is not None and script.script_type == 'R' and applied_checksums.get(script.script_full_path) == checksum:
+    print(f"Skipping change script {script.script_full_path}, checksum unchanged since the last deployment")
+    if metrics is not None:
+      metrics.add_script(script, 'unchanged', seconds=time.perf_counter() - script_start)
+    return False
+
   execution_time = 0
   status = 'Success'  
+  query_ids = None
 
   # Execute the contents of the script
-  if len(content) > 0:
-    start = time.time()
-    execute_snowflake_query(snowflake_connection, content, autocommit, verbose)
-    end = time.time()
-    execution_time = round(end - start)
+  # Execution time is kept to the millisecond, whole seconds recorded most scripts as 0
+  if streaming:
+    hasher = hashlib.sha224()
+    start = time.perf_counter()
+    with timed_phase(metrics, 'script_execute'):
+      statements = report_progress(stream_change_script(script, database_environment, hasher), script.script_full_path)
+      statement_count = get_query_executor(snowflake_connection, autocommit, verbose).execute_statements(statements)
+    end = time.perf_counter()
+    execution_time = round(end - start, 3)
+    query_ids = get_query_executor(snowflake_connection, autocommit, verbose).last_query_ids
+    checksum = hasher.hexdigest()
+    if metadata_cache is not None:
+      metadata_cache.put_checksum(script.script_full_path, database_environment, checksum)
+    print(f"Executed {statement_count} statement(s) of {script.script_full_path}")
+  elif len(content) > 0:
+    start = time.perf_counter()
+    with timed_phase(metrics, 'script_execute'):
+      execute_snowflake_query(snowflake_connection, content, autocommit, verbose)
+    end = time.perf_counter()
+    execution_time = round(end - start, 3)
+    query_ids = get_query_executor(snowflake_connection, autocommit, verbose).last_query_ids
 
   # Finally record this change in the change history table
-  query = """INSERT INTO {0}.{1}.{2} (BUILD_ID, BUILD_START_TIME, DESCRIPTION, SCRIPT, SCRIPT_TYPE, CHECKSUM, EXECUTION_TIME, STATUS, INSTALLED_BY, INSTALLED_ON, SCRIPT_PATH, PIPELINE_NAME) 
-           values ('{3}',to_timestamp_ntz('{4}', 'yyyymmddhh24miss'),'{5}','{6}','{7}','{8}','{9}','{10}', '{11}', CURRENT_TIMESTAMP, '{12}', '{13}');""".format(change_history_table['database_name'], 
-                                                                                                  change_history_table['schema_name'], 
-                                                                                                  change_history_table['table_name'], 
-                                                                                                  build_id,
-                                                                                                  build_start_time,
-                                                                                                  script['script_description'], 
-                                                                                                  script['script_name'], 
-                                                                                                  script['script_type'], 
-                                                                                                  checksum, 
-                                                                                                  execution_time, 
-                                                                                                  status, 
-                                                                                                  os.environ["SNOWFLAKE_USER"],
-                                                                                                  script['script_full_path'],
-                                                                                                  pipeline_name
-                                                                                                 )
-
-  execute_snowflake_query(snowflake_connection, query, autocommit, verbose)
-
-
-def apply_change_script(snowflake_connection, script, vars, change_history_table, autocommit, verbose, build_id, build_start_time, pipeline_name, database_environment):
-    script_name = script['script_name']
-
-    # Extract environment values from the script name
-    env_values = extract_env(script_name)
-
+  with timed_phase(metrics, 'script_record'):
+    if history_writer is None:
+      history_writer = ChangeHistoryWriter(snowflake_connection, change_history_table, autocommit, max_rows=1)
+    history_writer.add(build_id, build_start_time, script, checksum, execution_time, status, snowflake_connection.user, pipeline_name, query_ids)
+  if metrics is not None:
+    metrics.add_script(script, 'applied', seconds=time.perf_counter() - script_start, execution_seconds=execution_time)
+  return True
+
+
+def is_script_for_environment(script, database_environment):
+    # Scripts named with (DEV), (TST), (PREPROD) or (PRD) only apply to those environments
+    return script.is_for_environment(database_environment)
+
+
+def get_script_checksum(script, database_environment, stream_min_bytes=None, metadata_cache=None):
+  # Checksum of the script as it would be executed, read in chunks for the scripts that are streamed
+  if metadata_cache is not None:
+    checksum = metadata_cache.get_checksum(script.script_full_path, database_environment)
+    if checksum is not None:
+      return checksum
+  if stream_min_bytes is not None and os.path.getsize(script.script_full_path) >= stream_min_bytes:
+    hasher = hashlib.sha224()
+    for statement in stream_change_script(script, database_environment, hasher):
+      pass
+    checksum = hasher.hexdigest()
+  else:
+    checksum = hashlib.sha224(read_change_script(script, database_environment).encode('utf-8')).hexdigest()
+  if metadata_cache is not None:
+    metadata_cache.put_checksum(script.script_full_path, database_environment, checksum)
+  return checksum
+
+
+def apply_change_script(snowflake_connection, script, vars, change_history_table, autocommit, verbose, build_id, build_start_time, pipeline_name, database_environment, applied_checksums=None, history_writer=None, stream_min_bytes=None, metrics=None, metadata_cache=None):
     # Check if there are environment values to process
-    if (env_values is None) or (env_values and any(database_environment == value for value in env_values)):
-      print("Applying change script %s" % script['script_full_path'])
-      execute_and_record_change(snowflake_connection, script, vars, change_history_table, autocommit, verbose, build_id, build_start_time, pipeline_name, database_environment)
-      return True  # Script applied successfully
+    if is_script_for_environment(script, database_environment):
+      print("Applying change script %s" % script.script_full_path)
+      # False when the script was skipped because its checksum did not change
+      return execute_and_record_change(snowflake_connection, script, vars, change_history_table, autocommit, verbose, build_id, build_start_time, pipeline_name, database_environment, applied_checksums, history_writer, stream_min_bytes, metrics, metadata_cache)
     else:
-      print(f"Skipping change script {script['script_full_path']}")
+      print(f"Skipping change script {script.script_full_path}")
+      if metrics is not None:
+        metrics.add_script(script, 'other environment')
       return False  # Script skipped
 
-def replace_env(content, database_environment):
-
-  env_db_lakehouse_replace = ""
-  env_db_coedw_replace = ""
-  env_db_system_integration_replace = ""
-  env_db_CO_DATASCIENCELAB_replace = ""
-  env_db_CO_PLANDATA_replace = ""
-  env_db_CO_SHARED_replace = ""
-
-  if database_environment and database_environment.strip() != "":
-      database_environment = database_environment.strip() 
-      env_db_lakehouse_replace = env_dict_lakehouse.get(database_environment)
-      env_db_coedw_replace = env_dict_coedw.get(database_environment) 
-      env_db_system_integration_replace = env_dict_system_integration.get(database_environment)
-      env_db_CO_DATASCIENCELAB_replace = env_dict_CO_DATASCIENCELAB.get(database_environment)
-      env_db_CO_PLANDATA_replace = env_dict_CO_PLANDATA.get(database_environment)
-      env_db_CO_SHARED_replace = env_dict_CO_SHARED.get(database_environment)
-
-  #Replace for LAKEHOUSE database,if exists
-  for env_db in env_db_list_lakehouse:
-    if (env_db != env_db_lakehouse_replace) and (f"{env_db}." in content):
-      if env_db_lakehouse_replace and env_db_lakehouse_replace.strip() != "":
-        content = content.replace(f"{env_db}.",(f"{env_db_lakehouse_replace.strip()}."))
-        print(f"replace_env()- {env_db} exists, replaced with {env_db_lakehouse_replace}")
-
-  # Replace for COEDW database, if exists
-  for env_db in env_db_list_coedw:
-    if (env_db != env_db_coedw_replace) and (f"{env_db}." in content) and (f"{env_db}" !="COEDW_PREPROD"):       
-      if env_db_coedw_replace and env_db_coedw_replace.strip() != "":
-        content = content.replace(f"{env_db}.", f"{env_db_coedw_replace.strip()}.")
-        print(f"replace_env()- {env_db} exists, replaced with {env_db_coedw_replace}")
-
-  #Replace for system_integration database,if exists
-  for env_db in env_db_list_system_integration:
-    if (env_db != env_db_system_integration_replace) and (f"{env_db}." in content):
-      if env_db_system_integration_replace and env_db_system_integration_replace.strip() != "":
-        content = content.replace(f"{env_db}.",(f"{env_db_system_integration_replace.strip()}."))
-        print(f"replace_env()- {env_db} exists, replaced with {env_db_system_integration_replace}")
-
-  #Replace for CO_DATASCIENCELAB database,if exists
-  for env_db in env_db_list_CO_DATASCIENCELAB:
-    if (env_db != env_db_CO_DATASCIENCELAB_replace) and (f"{env_db}." in content):
-        if env_db_CO_DATASCIENCELAB_replace and env_db_CO_DATASCIENCELAB_replace.strip() != "":
-          content = content.replace(f"{env_db}.",(f"{env_db_CO_DATASCIENCELAB_replace.strip()}."))
-          print(f"replace_env()- {env_db} exists, replaced with {env_db_CO_DATASCIENCELAB_replace}")
-
-  #Replace for CO_PLANDATA database,if exists
-  for env_db in env_db_list_CO_PLANDATA:
-    if (env_db != env_db_CO_PLANDATA_replace) and (f"{env_db}." in content):
-        if env_db_CO_PLANDATA_replace and env_db_CO_PLANDATA_replace.strip() != "":
-          content = content.replace(f"{env_db}.",(f"{env_db_CO_PLANDATA_replace.strip()}."))
-          print(f"replace_env()- {env_db} exists, replaced with {env_db_CO_PLANDATA_replace}")
-  
-  #Replace for CO_SHARED database,if exists
-  for env_db in env_db_list_CO_SHARED:
-    if (env_db != env_db_CO_SHARED_replace) and (f"{env_db}." in content):
-        if env_db_CO_SHARED_replace and env_db_CO_SHARED_replace.strip() != "":
-          content = content.replace(f"{env_db}.",(f"{env_db_CO_SHARED_replace.strip()}."))
-          print(f"replace_env()- {env_db} exists, replaced with {env_db_CO_SHARED_replace}")
-
-  content = replace_warehouse_name(content, env_dict_warehouse, database_environment)
 
-  return content
+def get_apply_batches(scripts):
+    # Consecutive R scripts from the same order-file tier form one batch that can be applied concurrently,
+    # every V script is a batch on its own so versioned changes stay strictly sequential
+    batches = []
+    for script in scripts:
+        previous = batches[-1][0] if batches else None
+        if previous is not None and script.script_type == 'R' and previous.script_type == 'R' and script.script_tier == previous.script_tier:
+            batches[-1].append(script)
+        else:
+            batches.append([script])
+    return batches
+
+
+def cancel_session_queries(snowflake_connection, sessions):
+    # Abort whatever is still running on the worker sessions, so a failure does not wait for long scripts
+    for session in sessions:
+        session_id = getattr(session, 'session_id', None)
+        if session_id is None:
+            continue
+        try:
+            snowflake_connection.execute_string(f"SELECT SYSTEM$CANCEL_ALL_QUERIES({session_id})")
+            print(f"Cancelled in-flight queries of session {session_id}")
+        except Exception as error:
+            print(f"Unable to cancel queries of session {session_id}: {error}")
 
 
-def update_build_info_table(snowflake_connection, buildid_info_table, autocommit, verbose, current_head, pipeline_name, build_start_time, all_r_scripts, all_v_scripts):
-    all_scripts = ''
-    all_scripts_list = []
-    if len(all_v_scripts) > 0:
-        for scripts in all_v_scripts.values():
-            all_scripts_list.append(scripts['script_name'])
-    if len(all_r_scripts) > 0:
-        for scripts in all_r_scripts.values():
-            all_scripts_list.append(scripts['script_name'])
-    all_scripts = ','.join(all_scripts_list)
+def apply_change_scripts_parallel(snowflake_connection, scripts, parallel, vars, change_history_table, autocommit, verbose, build_id, build_start_time, pipeline_name, database_environment, applied_checksums=None, history_writer=None, stream_min_bytes=None, connection_manager=None, metrics=None, metadata_cache=None):
+    scripts_applied = 0
+    scripts_skipped = 0
+    batches = get_apply_batches(scripts)
+
+    # Open the worker sessions only when some batch can actually run concurrently
+    largest_batch = max([len(batch) for batch in batches], default=0)
+    pool_size = min(parallel, largest_batch)
+    sessions = queue.Queue()
+    opened_sessions = []
+    if pool_size > 1:
+        if connection_manager is None:
+            raise ValueError("A connection manager is required to open sessions for parallel apply")
+        print(f"Using {pool_size} Snowflake sessions for parallel apply")
+        for _ in range(pool_size):
+            session = connection_manager.acquire(database=get_query_executor(snowflake_connection, autocommit, verbose).database)
+            opened_sessions.append(session)
+            sessions.put(session)
+
+    failed = threading.Event()
+    first_failure = []
+    busy_lock = threading.Lock()
+    busy_sessions = dict()
+
+    def apply_in_session(script):
+        if failed.is_set():
+            return None
+        session = sessions.get()
+        with busy_lock:
+            busy_sessions[script.script_full_path] = session
+        try:
+            return apply_change_script(session, script, vars, change_history_table, autocommit, verbose, build_id, build_start_time, pipeline_name, database_environment, applied_checksums, history_writer, stream_min_bytes, metrics, metadata_cache)
+        except Exception as error:
+            with busy_lock:
+                first = not failed.is_set()
+                if first:
+                    failed.set()
+                    first_failure.append(error)
+                    in_flight = [busy for path, busy in busy_sessions.items() if path != script.script_full_path]
+            if first:
+                cancel_session_queries(snowflake_connection, in_flight)
+            raise
+        finally:
+            with busy_lock:
+                del busy_sessions[script.script_full_path]
+            sessions.put(session)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(pool_size, 1)) as executor:
+            for batch_number, batch in enumerate(batches, start=1):
+                if len(batch) == 1 or pool_size <= 1:
+                    # V scripts and single R scripts run on the main connection, exactly like the sequential loop
+                    for script in batch:
+                        if apply_change_script(snowflake_connection, script, vars, change_history_table, autocommit, verbose, build_id, build_start_time, pipeline_name, database_environment, applied_checksums, history_writer, stream_min_bytes, metrics, metadata_cache):
+                            scripts_applied += 1
+                        else:
+                            scripts_skipped += 1
+                    continue
+
+                print(f"Applying batch {batch_number} of {len(batches)} with {len(batch)} R script(s) concurrently")
+                futures = [executor.submit(apply_in_session, script) for script in batch]
+
+                # Collect the outcome of every worker in script order, so the summary does not depend on timing
+                errors = []
+                cancelled = 0
+                for script, future in zip(batch, futures):
+                    try:
+                        result = future.result()
+                    except Exception as error:
+                        errors.append((script, error))
+                        continue
+                    if result is None:
+                        cancelled += 1
+                    elif result:
+                        scripts_applied += 1
+                    else:
+                        scripts_skipped += 1
+
+                if errors:
+                    print(f"{len(errors)} script(s) failed in batch {batch_number}, {cancelled} script(s) were not started")
+                    for script, error in errors:
+                        print(f"Failed change script {script.script_full_path}: {error}")
+                    raise first_failure[0] if first_failure else errors[0][1]
+    finally:
+        main_executor = get_query_executor(snowflake_connection, autocommit, verbose)
+        for session in opened_sessions:
+            session_executor = get_query_executor(session, autocommit, verbose)
+            main_executor.round_trips_saved += session_executor.round_trips_saved
+            session_executor.round_trips_saved = 0
+            connection_manager.release(session)
+
+    return scripts_applied, scripts_skipped
+
+
+async def apply_batch_async(snowflake_connection, batch, max_concurrency, change_history_table, autocommit, verbose, build_id, build_start_time, pipeline_name, history_writer, metrics=None, poll_seconds=1):
+    # Submits every (script, content, checksum) of the batch with execute_async, at most max_concurrency at a
+    # time, and polls the status of the running queries. Each script is recorded as soon as its query finished.
+    # The first failure cancels the queries still running and stops the submission of the rest
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    query_executor = get_query_executor(snowflake_connection, autocommit, verbose)
+    query_executor.use('DATABASE', query_executor.database)
+    query_executor.use('WAREHOUSE', query_executor.warehouse)
+    semaphore = asyncio.Semaphore(max_concurrency)
+    running_queries = dict()
+    failures = []
+
+    def submit(content):
+        cursor = snowflake_connection.cursor()
+        try:
+            # num_statements=0 accepts scripts with any number of statements
+            cursor.execute_async(query_executor.replace_stage(content), num_statements=0)
+            return cursor.sfqid
+        finally:
+            cursor.close()
+
+    def cancel_running_queries():
+        for query_id in list(running_queries.values()):
+            try:
+                snowflake_connection.execute_string(f"SELECT SYSTEM$CANCEL_QUERY('{query_id}')")
+                print(f"Cancelled query {query_id}")
+            except Exception as error:
+                print(f"Unable to cancel query {query_id}: {error}")
+
+    async def apply_script(script, content, checksum):
+        async with semaphore:
+            if failures:
+                return None
+            print("Applying change script %s" % script.script_full_path)
+            start = time.perf_counter()
+            try:
+                query_id = await loop.run_in_executor(None, submit, content)
+                running_queries[script.script_full_path] = query_id
+                # Poll quickly first, most scripts finish in well under a second
+                interval = min(0.05, poll_seconds)
+                while True:
+                    status = await loop.run_in_executor(None, snowflake_connection.get_query_status_throw_if_error, query_id)
+                    if not snowflake_connection.is_still_running(status):
+                        break
+                    await asyncio.sleep(interval)
+                    interval = min(interval * 2, poll_seconds)
+            except Exception as error:
+                running_queries.pop(script.script_full_path, None)
+                if not failures:
+                    failures.append((script, error))
+                    await loop.run_in_executor(None, cancel_running_queries)
+                raise
+            running_queries.pop(script.script_full_path, None)
+
+        execution_time = round(time.perf_counter() - start, 3)
+        print(f"Applied change script {script.script_full_path} in {execution_time:.3f}s")
+        with timed_phase(metrics, 'script_record'):
+            history_writer.add(build_id, build_start_time, script, checksum, execution_time, 'Success', snowflake_connection.user, pipeline_name, [query_id])
+        if metrics is not None:
+            metrics.add_script(script, 'applied', seconds=time.perf_counter() - start, execution_seconds=execution_time)
+        return True
+
+    results = await asyncio.gather(*[apply_script(script, content, checksum) for script, content, checksum in batch], return_exceptions=True)
+    if failures:
+        not_started = sum(1 for result in results if result is None)
+        print(f"{sum(1 for result in results if isinstance(result, Exception))} script(s) failed, {not_started} script(s) were not started")
+        for script, result in zip(batch, results):
+            if isinstance(result, Exception):
+                print(f"Failed change script {script[0].script_full_path}: {result}")
+        raise failures[0][1]
+    return sum(1 for result in results if result)
+
+
+def read_batched_script(script, database_environment, applied_checksums=None, stream_min_bytes=None, metrics=None, metadata_cache=None):
+    # (content, checksum) of an R script that can be submitted together with other scripts, False when it is
+    # unchanged since the last deployment and None when it has to be applied on its own: streamed scripts,
+    # scripts of other environments, empty scripts and scripts that change the session state
+    streaming = stream_min_bytes is not None and os.path.getsize(script.script_full_path) >= stream_min_bytes
+    if streaming or not is_script_for_environment(script, database_environment):
+        return None
+    checksum = metadata_cache.get_checksum(script.script_full_path, database_environment) if metadata_cache is not None else None
+    content = None
+    if checksum is None or applied_checksums is None or applied_checksums.get(script.script_full_path) != checksum:
+        content = read_change_script(script, database_environment, metrics)
+        checksum = hashlib.sha224(content.encode('utf-8')).hexdigest()
+        if metadata_cache is not None:
+            metadata_cache.put_checksum(script.script_full_path, database_environment, checksum)
+    if applied_checksums is not None and applied_checksums.get(script.script_full_path) == checksum:
+        print(f"Skipping change script {script.script_full_path}, checksum unchanged since the last deployment")
+        if metrics is not None:
+            metrics.add_script(script, 'unchanged')
+        return False
+    if content and not SnowflakeQueryExecutor.state_changing_pattern.search(content):
+        return content, checksum
+    return None
+
+
+def apply_change_scripts_async(snowflake_connection, scripts, max_concurrency, vars, change_history_table, autocommit, verbose, build_id, build_start_time, pipeline_name, database_environment, applied_checksums=None, history_writer=None, stream_min_bytes=None, metrics=None, poll_seconds=1, metadata_cache=None):
+    # R scripts of the same order tier are submitted as asynchronous queries on the deployment session and run
+    # concurrently on the warehouse. V scripts, streamed scripts and scripts that change the session state
+    # (USE, CREATE DATABASE/SCHEMA, CALL) are applied one at a time like the sequential loop
+    # Only loaded for the asynchronous apply, like the connector
+    import asyncio
+
+    scripts_applied = 0
+    scripts_skipped = 0
+    if history_writer is None:
+        history_writer = ChangeHistoryWriter(snowflake_connection, change_history_table, autocommit, max_rows=1)
+
+    for batch_number, batch in enumerate(get_apply_batches(scripts), start=1):
+        if len(batch) == 1:
+            if apply_change_script(snowflake_connection, batch[0], vars, change_history_table, autocommit, verbose, build_id, build_start_time, pipeline_name, database_environment, applied_checksums, history_writer, stream_min_bytes, metrics, metadata_cache):
+                scripts_applied += 1
+            else:
+                scripts_skipped += 1
+            continue
+
+        concurrent_scripts = []
+        for script in batch:
+            batched_script = read_batched_script(script, database_environment, applied_checksums, stream_min_bytes, metrics, metadata_cache)
+            if batched_script is False:
+                scripts_skipped += 1
+                continue
+            if batched_script is not None:
+                concurrent_scripts.append((script,) + batched_script)
+                continue
+            if apply_change_script(snowflake_connection, script, vars, change_history_table, autocommit, verbose, build_id, build_start_time, pipeline_name, database_environment, applied_checksums, history_writer, stream_min_bytes, metrics, metadata_cache):
+                scripts_applied += 1
+            else:
+                scripts_skipped += 1
+
+        if concurrent_scripts:
+            print(f"Submitting batch {batch_number} with {len(concurrent_scripts)} R script(s) as asynchronous queries")
+            with timed_phase(metrics, 'async_batch'):
+                scripts_applied += asyncio.run(apply_batch_async(snowflake_connection, concurrent_scripts, max_concurrency, change_history_table, autocommit, verbose, build_id, build_start_time, pipeline_name, history_writer, metrics, poll_seconds))
+
+    return scripts_applied, scripts_skipped
+
+
+def get_completed_statement_ids(snowflake_connection, autocommit, verbose, parent_query_id, statements):
+    # Query IDs of the statements of a failed multi-statement query that completed before the failing one, taken
+    # from the query history of the session. None when the query cannot be found there
+    if not parent_query_id:
+        return None
+
+    def normalize(statement):
+        return ' '.join(sql_comment_pattern.sub(' ', statement).split()).rstrip(';').rstrip()
+
+    query = """SELECT QUERY_ID, QUERY_TEXT, EXECUTION_STATUS FROM TABLE(INFORMATION_SCHEMA.QUERY_HISTORY_BY_SESSION(RESULT_LIMIT => {0}))
+               ORDER BY START_TIME;""".format(len(statements) * 2 + 100)
+    rows = execute_snowflake_query(snowflake_connection, query, autocommit, verbose)[0].fetchall()
+    parent_positions = [position for position, row in enumerate(rows) if row[0] == parent_query_id]
+    if not parent_positions:
+        return None
+    # The statements run in order after the query holding them. Other queries of the session, like a history flush,
+    # may run in between, only the ones with the text of the next statement count
+    completed_ids = []
+    for query_id, query_text, execution_status in rows[parent_positions[0] + 1:]:
+        if len(completed_ids) == len(statements) or normalize(query_text) != normalize(statements[len(completed_ids)]):
+            continue
+        if execution_status != 'SUCCESS':
+            break
+        completed_ids.append(query_id)
+    return completed_ids
+
+
+def record_coalesced_scripts(snowflake_connection, group, query_ids, execution_time, build_id, build_start_time, pipeline_name, history_writer, metrics=None):
+    # A CHANGE_HISTORY row per (script, content, checksum, statements) with its own checksum and the query IDs of its
+    # statements, the execution time is shared out by statement count
+    statement_count = sum(len(statements) for script, content, checksum, statements in group)
+    first_statement = 0
+    for script, content, checksum, statements in group:
+        script_execution_time = round(execution_time * len(statements) / statement_count, 3)
+        script_query_ids = query_ids[first_statement:first_statement + len(statements)] if query_ids else None
+        first_statement += len(statements)
+        with timed_phase(metrics, 'script_record'):
+            history_writer.add(build_id, build_start_time, script, checksum, script_execution_time, 'Success', snowflake_connection.user, pipeline_name, script_query_ids)
+        if metrics is not None:
+            metrics.add_script(script, 'applied', seconds=script_execution_time, execution_seconds=script_execution_time)
+
+
+def apply_coalesced_scripts(snowflake_connection, group, vars, change_history_table, autocommit, verbose, build_id, build_start_time, pipeline_name, database_environment, applied_checksums=None, history_writer=None, stream_min_bytes=None, metrics=None, metadata_cache=None):
+    # Submits the (script, content, checksum, statements) of the group as one multi-statement query and records a
+    # row per script. When the query fails, the statements that completed are looked up in the query history: the
+    # scripts before the failing statement are recorded as applied and the error is reported for the script of the
+    # failing statement. Without autocommit the failure rolled back the group, and when the failing statement
+    # cannot be found, the scripts are applied one at a time instead
+    if len(group) == 1:
+        return 1 if apply_change_script(snowflake_connection, group[0][0], vars, change_history_table, autocommit, verbose, build_id, build_start_time, pipeline_name, database_environment, applied_checksums, history_writer, stream_min_bytes, metrics, metadata_cache) else 0
+    statement_count = sum(len(statements) for script, content, checksum, statements in group)
+    print(f"Applying {len(group)} change script(s) with {statement_count} statement(s) in one query: {', '.join(script.script_name for script, content, checksum, statements in group)}")
+    query_executor = get_query_executor(snowflake_connection, autocommit, verbose)
+    start = time.perf_counter()
+    try:
+        with timed_phase(metrics, 'script_execute'):
+            query_executor.execute_multi_statement('\n'.join(statement for script, content, checksum, statements in group for statement in statements), statement_count)
+    except Exception as error:
+        execution_time = time.perf_counter() - start
+        completed_ids = None
+        if autocommit:
+            completed_ids = get_completed_statement_ids(snowflake_connection, autocommit, verbose, getattr(error, 'sfqid', None), [query_executor.replace_stage(statement) for script, content, checksum, statements in group for statement in statements])
+        if completed_ids is None:
+            print(f"The combined query failed ({error}), applying its {len(group)} change script(s) one at a time")
+            return sum(1 for script, content, checksum, statements in group if apply_change_script(snowflake_connection, script, vars, change_history_table, autocommit, verbose, build_id, build_start_time, pipeline_name, database_environment, applied_checksums, history_writer, stream_min_bytes, metrics, metadata_cache))
+        completed_scripts = []
+        completed_statements = 0
+        for entry in group:
+            if completed_statements + len(entry[3]) > len(completed_ids):
+                failed_script = entry[0]
+                break
+            completed_scripts.append(entry)
+            completed_statements += len(entry[3])
+        if completed_scripts:
+            record_coalesced_scripts(snowflake_connection, completed_scripts, completed_ids, execution_time * completed_statements / statement_count, build_id, build_start_time, pipeline_name, history_writer, metrics)
+        print(f"Applied {len(completed_scripts)} change script(s) of the combined query, it failed in change script {failed_script.script_full_path}")
+        raise error
+    execution_time = time.perf_counter() - start
+    # One query ID per statement, in the order of the statements
+    query_ids = query_executor.last_query_ids if len(query_executor.last_query_ids) == statement_count else None
+    record_coalesced_scripts(snowflake_connection, group, query_ids, execution_time, build_id, build_start_time, pipeline_name, history_writer, metrics)
+    return len(group)
+
+
+def apply_change_scripts_coalesced(snowflake_connection, scripts, max_bytes, max_statements, vars, change_history_table, autocommit, verbose, build_id, build_start_time, pipeline_name, database_environment, applied_checksums=None, history_writer=None, stream_min_bytes=None, metrics=None, metadata_cache=None):
+    # Sequential apply where consecutive R scripts of the same order tier of up to max_bytes are submitted as one
+    # multi-statement query of at most max_statements statements. Most R scripts are a single short CREATE OR
+    # REPLACE VIEW, one round trip per script costs more than the statement itself. V scripts, larger scripts and
+    # the scripts read_batched_script turns down are applied one at a time, in their order
+    scripts_applied = 0
+    scripts_skipped = 0
+    if history_writer is None:
+        history_writer = ChangeHistoryWriter(snowflake_connection, change_history_table, autocommit, max_rows=1)
+
+    for batch in get_apply_batches(scripts):
+        group = []
+        group_statements = 0
+        for script in batch:
+            batched_script = None
+            if script.script_type == 'R' and os.path.getsize(script.script_full_path) <= max_bytes:
+                batched_script = read_batched_script(script, database_environment, applied_checksums, stream_min_bytes, metrics, metadata_cache)
+            if batched_script is False:
+                scripts_skipped += 1
+                continue
+            statements = []
+            if batched_script is not None:
+                # Every statement keeps its ; or gets one on a line of its own, after a trailing comment it would be lost
+                statements = [statement if statement.rstrip().endswith(';') else statement + '\n;' for statement in split_sql_statements([batched_script[0]]) if is_executable_statement(statement)]
+            if group and (not statements or group_statements + len(statements) > max_statements):
+                scripts_applied += apply_coalesced_scripts(snowflake_connection, group, vars, change_history_table, autocommit, verbose, build_id, build_start_time, pipeline_name, database_environment, applied_checksums, history_writer, stream_min_bytes, metrics, metadata_cache)
+                group = []
+                group_statements = 0
+            if statements:
+                group.append((script,) + batched_script + (statements,))
+                group_statements += len(statements)
+            elif apply_change_script(snowflake_connection, script, vars, change_history_table, autocommit, verbose, build_id, build_start_time, pipeline_name, database_environment, applied_checksums, history_writer, stream_min_bytes, metrics, metadata_cache):
+                scripts_applied += 1
+            else:
+                scripts_skipped += 1
+        if group:
+            scripts_applied += apply_coalesced_scripts(snowflake_connection, group, vars, change_history_table, autocommit, verbose, build_id, build_start_time, pipeline_name, database_environment, applied_checksums, history_writer, stream_min_bytes, metrics, metadata_cache)
+
+    return scripts_applied, scripts_skipped
+
+
+def build_deployment_plan(scripts, database_environment, runtime_history, applied_checksums=None, parallel=None, stream_min_bytes=None, default_script_seconds=1, metadata_cache=None):
+    # What a deployment of the ordered scripts would do, without executing anything. Durations are the average
+    # runtime from the change history, the critical path is the time with unlimited sessions for concurrent batches
+    plan_scripts = []
+    estimated_seconds = 0
+    predicted_seconds = 0
+    critical_path_seconds = 0
+    for batch_number, batch in enumerate(get_apply_batches(scripts), start=1):
+        batch_seconds = []
+        for script in batch:
+            checksum = get_script_checksum(script, database_environment, stream_min_bytes, metadata_cache)
+            skip_reason = None
+            if not is_script_for_environment(script, database_environment):
+                skip_reason = f"not for environment {database_environment}"
+            elif applied_checksums is not None and script.script_type == 'R' and applied_checksums.get(script.script_full_path) == checksum:
+                skip_reason = "checksum unchanged since the last deployment"
+
+            average_seconds = runtime_history.get(script.script_full_path)
+            if skip_reason is None:
+                batch_seconds.append(average_seconds if average_seconds is not None else default_script_seconds)
+            plan_scripts.append({
+                'order': len(plan_scripts) + 1,
+                'batch': batch_number,
+                'script_name': script.script_name,
+                'script_full_path': script.script_full_path,
+                'script_type': script.script_type,
+                'script_tier': script.script_tier,
+                'action': 'skip' if skip_reason else 'apply',
+                'skip_reason': skip_reason,
+                'checksum': checksum,
+                'average_seconds': average_seconds
+            })
+
+        if batch_seconds:
+            estimated_seconds += sum(batch_seconds)
+            critical_path_seconds += max(batch_seconds)
+            # A batch runs on at most parallel sessions, it takes at least as long as its longest script
+            sessions = parallel if parallel and parallel > 1 else 1
+            predicted_seconds += max(max(batch_seconds), sum(batch_seconds) / sessions)
+
+    return {
+        'database_environment': database_environment,
+        'parallel': parallel,
+        'scripts': plan_scripts,
+        'scripts_to_apply': len([script for script in plan_scripts if script['action'] == 'apply']),
+        'scripts_without_history': len([script for script in plan_scripts if script['action'] == 'apply' and script['average_seconds'] is None]),
+        'estimated_seconds': estimated_seconds,
+        'predicted_seconds': predicted_seconds,
+        'critical_path_seconds': critical_path_seconds
+    }
+
+
+def write_deployment_plan(plan, plan_file):
+    if plan_file == '-':
+        # The console run sends its progress to stderr, the JSON alone goes to stdout
+        print(json.dumps(plan, indent=2), file=sys.__stdout__, flush=True)
+    else:
+        with open(plan_file, 'w') as f:
+            json.dump(plan, f, indent=2)
+        print(f"Deployment plan written to {plan_file}")
+    print(f"Plan: {plan['scripts_to_apply']} of {len(plan['scripts'])} script(s) to apply, estimated {plan['estimated_seconds']:.0f}s sequential, {plan['predicted_seconds']:.0f}s predicted, {plan['critical_path_seconds']:.0f}s critical path")
+
+
+# Compiled rewriters by environment, scripts of one run share the rewriter of their environment
+env_rewriters = dict()
+
+
+def get_env_config_fingerprint():
+    # Rendered content depends on the environment configuration and on this version of the rewrite
+    return hashlib.sha224(json.dumps([_snowchange_version, env_config], sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def replace_env(content, database_environment, messages=None):
+  rewriter = env_rewriters.get(database_environment)
+  if rewriter is None:
+    rewriter = env_rewriters.setdefault(database_environment, EnvironmentRewriter(env_config, database_environment))
+  return rewriter.rewrite(content, messages)
+
+
+def update_build_info_table(snowflake_connection, buildid_info_table, autocommit, verbose, current_head, pipeline_name, build_start_time, script_catalog):
+    all_scripts = ','.join(script.script_name for script in script_catalog)
 
     query = "INSERT INTO {0}.{1}.{2} (SUCCESSFUL_BUILD_ID, PIPELINE_NAME, DATE, SQL_SCRIPTS) VALUES('{3}','{4}', to_timestamp_ntz('{5}', 'yyyymmddhh24miss'),'{6}');".format(buildid_info_table['database_name'], buildid_info_table['schema_name'], buildid_info_table['buildinfo_table_name'], current_head, pipeline_name, build_start_time, all_scripts)
     execute_snowflake_query(snowflake_connection, query, autocommit, verbose)
@@ -457,7 +1902,7 @@ if __name__ == '__main__':
     parser.add_argument('-u', '--snowflake-user', type=str, help='The name of the snowflake user (e.g. DEPLOYER)', required=True)
     parser.add_argument('-r', '--snowflake-role', type=str, help='The name of the role to use (e.g. DEPLOYER_ROLE)', required=True)
     parser.add_argument('-w', '--snowflake-warehouse', type=str, help='The name of the warehouse to use (e.g. DEPLOYER_WAREHOUSE)', required=True)
-    parser.add_argument('-d', '--snowflake-database', type=str, help='The name of the database to use (e.g. COEDW)', required=True)
+    parser.add_argument('-d', '--snowflake-database', type=str, help='The name of the database to use (e.g. COEDW), required unless every job of --batch-manifest names its database', required=False)
     parser.add_argument('-c', '--change-history-table', type=str, help='Used to override the default name of the change history table (e.g. SNOWCHANGE.CHANGE_HISTORY)', required=True)
     parser.add_argument('-b', '--build-id', type=str, help='Id of the current build', required=True)
     parser.add_argument('-t', '--build-start-time', type=str, help='Start time of the current build (format - yyyymmddhh24miss)', required=True)
@@ -466,13 +1911,55 @@ if __name__ == '__main__':
     parser.add_argument('-v', '--verbose', action='store_true')
     parser.add_argument('-al', '--account_level_file', type=str, help='It helps to know files are account level or not', required=False)
     parser.add_argument('-pn', '--pipeline-name', type=str, required=False)
-    parser.add_argument('-de', '--database-environment', type=str, help="Environment variable", required=False)
+    parser.add_argument('-de', '--database-environment', type=str, nargs='+', help="Environment variable. Several environments (e.g. dev tst preprod) are deployed concurrently from one discovery, each to the database of its environment in the family of --snowflake-database", required=False)
     parser.add_argument('-bi', '--build-info-table', type=str, help='The name of the Snowflake table for storing the build information', required=False)
     parser.add_argument('-lsi', '--last-success-build-id', type=str, help='Git commit number from the last successful build of the branch which is required for getting git diff files', required=False)
     parser.add_argument('-ch', '--current-head', type=str, help='Git commit number from the head of the branch which is required for getting git diff files', required=False)
     parser.add_argument('-st', '--access-token', type=str, help='Security access token', required=False)
     parser.add_argument('-rid', '--repository_id', type=str, help='Repository id', required=False)
     parser.add_argument('-dwhsd', '--deployment_warehouse_size_dict', type=json.loads, help='JSON dictionary mapping environments to warehouse sizes (e.g. {"dev": "SMALL", "prod": "MEDIUM"})', required=False)
+    parser.add_argument('-p', '--parallel', type=int, help='Number of Snowflake sessions used to apply R scripts of the same order tier concurrently (default: sequential)', required=False)
+    parser.add_argument('-aa', '--async-apply', type=int, help='Number of R scripts of the same order tier submitted as concurrent asynchronous queries on the deployment session, requires --autocommit (default: sequential)', required=False)
+    parser.add_argument('-aps', '--async-poll-seconds', type=float, default=1, help='Longest wait between two status checks of a running asynchronous query (default: 1)', required=False)
+    parser.add_argument('-do', '--dependency-order', action='store_true', help='Order the change scripts by the objects they create and reference instead of the order file')
+    parser.add_argument('-ord', '--order-root-depth', type=int, default=9, help='Number of leading path components ignored when matching script folders against the order file (default: 9)', required=False)
+    parser.add_argument('-cs', '--change-source', type=str, choices=['rest', 'git'], default='rest', help='Where the changes since the last successful build come from: the Azure DevOps REST API or the local git checkout (default: rest)', required=False)
+    parser.add_argument('-csp', '--change-source-paths', type=str, nargs='*', help='Repository folders the git change source is limited to (e.g. coEDW)', required=False)
+    parser.add_argument('-su', '--skip-unchanged', action='store_true', help='Skip R scripts whose checksum matches the last successful deployment recorded in the change history table')
+    parser.add_argument('-ckb', '--coalesce-max-kb', type=float, help='Submit consecutive R scripts of the same order tier of up to this many KB as one multi-statement query. Sequential apply only', required=False)
+    parser.add_argument('-cms', '--coalesce-max-statements', type=int, default=50, help='Most statements submitted in one query when coalescing (default: 50)', required=False)
+    parser.add_argument('-mch', '--migrate-change-history', action='store_true', help='Add the columns of this version (QUERY_IDS, EXECUTION_MS, WAREHOUSE_SIZE, COMMIT_ID) to the change history table before deploying. Needs a role allowed to alter the table, without them the columns are not recorded')
+    parser.add_argument('-hbs', '--history-batch-size', type=int, default=50, help='Number of change history rows written with one insert (default: 50)', required=False)
+    parser.add_argument('-hfs', '--history-flush-seconds', type=float, default=30, help='Longest time a change history row is buffered before it is written (default: 30)', required=False)
+    parser.add_argument('-smb', '--stream-min-mb', type=float, help='Change scripts of this size (in MB) and larger are read and executed statement by statement instead of being loaded whole', required=False)
+    parser.add_argument('-aws', '--adaptive-warehouse-size', action='store_true', help='Size the warehouse from the runtimes of the pending scripts in the change history table, up to the size in --deployment_warehouse_size_dict')
+    parser.add_argument('-wts', '--warehouse-target-seconds', type=float, default=900, help='Deployment time the adaptive warehouse size aims for (default: 900)', required=False)
+    parser.add_argument('-wcb', '--warehouse-credit-budget', type=float, help='Most credits the adaptive warehouse size may spend on the deployment', required=False)
+    parser.add_argument('-rs', '--resume', action='store_true', help='Rerun of a failed build: skip the scripts this build ID and pipeline already applied, as recorded in the change history table and the checkpoint file, and continue with the first one left')
+    parser.add_argument('-cpf', '--checkpoint-file', type=str, help='Append every successfully applied script to this file, so --resume also knows the scripts whose change history rows were not written yet. Removed once the deployment completed', required=False)
+    parser.add_argument('-pl', '--plan', type=str, help='Write the deployment plan as JSON to this file (- for the console) instead of deploying. Nothing is executed', required=False)
+    parser.add_argument('-pms', '--plan-max-seconds', type=float, help='Fail the plan when the predicted deployment time exceeds this many seconds', required=False)
+    parser.add_argument('-dcd', '--diff-cache-dir', type=str, help='Folder caching the Azure DevOps diff per repository and commit range, shared by later stages of the same build', required=False)
+    parser.add_argument('-adu', '--azure-devops-url', type=str, help='Base URL of the Azure DevOps git repositories API (default: %s)' % azure_devops_base_url, required=False)
+    parser.add_argument('-mcf', '--metadata-cache-file', type=str, help='File of the script metadata cache, script details and checksums of files unchanged since an earlier run on this agent are reused (default: no cache)', required=False)
+    parser.add_argument('-mcs', '--metadata-cache-size', type=int, default=50000, help='Number of scripts kept in the metadata cache, the least recently used are evicted (default: 50000)', required=False)
+    parser.add_argument('-bm', '--batch-manifest', type=str, help='JSON list of jobs, each a set of arguments (root_folder, snowflake_database, account_level_file, pipeline_name, ...) overriding the command line ones. The jobs run in this process with one diff fetch and shared logins, jobs of different databases concurrently', required=False)
+    parser.add_argument('-bmw', '--batch-max-workers', type=int, help='Number of databases deployed concurrently in batch mode (default: all)', required=False)
+    parser.add_argument('-br', '--batch-report', type=str, help='Write the result of every batch job as JSON to this file', required=False)
+    parser.add_argument('-mf', '--metrics-file', type=str, help='Write the time per phase and per script of the run to this file', required=False)
+    parser.add_argument('-mfm', '--metrics-format', type=str, choices=['json', 'prometheus'], default='json', help='Format of the metrics file, prometheus writes the node exporter textfile format (default: json)', required=False)
+    parser.add_argument('-ss', '--slowest-scripts', type=int, default=10, help='Number of scripts listed in the slowest scripts report, with queued, compilation and execution time from QUERY_HISTORY. 0 disables the report (default: 10)', required=False)
+    parser.add_argument('-ll', '--log-level', type=str, choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default='INFO', help='Level of the detail messages, DEBUG shows every database and warehouse rewrite (default: INFO, DEBUG with --verbose)', required=False)
+    parser.add_argument('-dmw', '--diff-max-workers', type=int, default=4, help='Number of diff pages requested concurrently from the Azure DevOps API (default: 4)', required=False)
 
     args = parser.parse_args()
-    snowchange(args.root_folder, args.snowflake_account, args.snowflake_user, args.snowflake_role, args.snowflake_warehouse, args.snowflake_database, args.change_history_table, args.build_id, args.build_start_time, args.vars, args.autocommit, args.verbose, args.account_level_file, args.pipeline_name, args.database_environment, args.build_info_table, args.last_success_build_id, args.current_head, args.access_token, args.repository_id, args.deployment_warehouse_size_dict)
+    if args.snowflake_database is None and args.batch_manifest is None:
+        parser.error("the following arguments are required: -d/--snowflake-database")
+    # With the plan on the console, stdout only holds the plan and everything else is written to stderr
+    with contextlib.redirect_stdout(sys.stderr) if args.plan == '-' else contextlib.nullcontext():
+        configure_logging(logging.DEBUG if args.verbose else args.log_level)
+        deployment_arguments = [args.root_folder, args.snowflake_account, args.snowflake_user, args.snowflake_role, args.snowflake_warehouse, args.snowflake_database, args.change_history_table, args.build_id, args.build_start_time, args.vars, args.autocommit, args.verbose, args.account_level_file, args.pipeline_name, args.database_environment, args.build_info_table, args.last_success_build_id, args.current_head, args.access_token, args.repository_id, args.deployment_warehouse_size_dict, args.parallel, args.dependency_order, args.order_root_depth, args.diff_cache_dir, args.diff_max_workers, args.change_source, args.change_source_paths, args.skip_unchanged, args.history_batch_size, args.history_flush_seconds, args.stream_min_mb, args.adaptive_warehouse_size, args.warehouse_target_seconds, args.warehouse_credit_budget, args.plan, args.plan_max_seconds, args.azure_devops_url, args.metrics_file, args.metrics_format, args.slowest_scripts, args.async_apply, args.async_poll_seconds, args.metadata_cache_file, args.metadata_cache_size, args.resume, args.checkpoint_file, args.coalesce_max_kb, args.coalesce_max_statements, args.migrate_change_history]
+        if args.batch_manifest:
+            run_batch(args.batch_manifest, inspect.signature(snowchange).bind(*deployment_arguments).arguments, args.batch_max_workers, args.batch_report)
+        else:
+            snowchange(*deployment_arguments)
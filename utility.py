@@ -1,78 +1,524 @@
-import requests
+import abc
 import base64
 import os
+import json
+import time
+import logging
+import contextlib
+import threading
+import subprocess
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import re
-import snowflake.connector
 
+# Detail messages (database and warehouse rewrites) go to this logger, the run itself still prints its progress
+logger = logging.getLogger('snowchange')
 
-def get_incremental_changes_list(current_head, last_success_build_id, root_directory, access_token, repository_id, account_level_file, pipeline_name):
+# Construct the API Base URL
+azure_devops_base_url = "https://dev.azure.com/CareOregonInc/coEDW_Analytics/_apis/git/repositories"
 
-    # Construct the API Base URL
-    base_url = "https://dev.azure.com/CareOregonInc/coEDW_Analytics/_apis/git/repositories"
 
-    # Update the repositories_url with repository_id
-    repositories_url = f"{base_url}/{repository_id}/diffs/commits"
-    # Define the authentication token
-    authorization = str(base64.b64encode(bytes(':'+access_token, 'ascii')), 'ascii')
+class ChangeSource(abc.ABC):
+    # Interface of the diff backends. get_changes returns the changes between two commits in the shape of the
+    # Azure DevOps diffs/commits API ({'item': {'path': '/folder/file.sql'}, 'changeType': 'edit'}), so every
+    # backend goes through the same filtering.
 
-    # header for request to the commit search API
-    headers = {
-        'Content-type': 'application/json',
-        'Accept': 'application/json, text/javascript',
-        'Authorization': 'Basic '+authorization
-    }
-    incremental_changes_list = []
-    # Set the initial skip value and maximum batch size
-    skip = 0
-    batch_size = 100
+    @abc.abstractmethod
+    def get_changes(self, base_version, target_version):
+        pass
+
+    def close(self):
+        pass
+
+
+class AzureDevOpsDiffClient(ChangeSource):
+    # Fetches the commit diff from the Azure DevOps REST API over one pooled session. Pages are requested
+    # concurrently, throttling and server errors are retried with backoff, and with a cache_dir the change
+    # set of a (repository, base, target) range is stored on disk so later stages do not need any HTTP.
+
+    def __init__(self, access_token, repository_id, base_url=azure_devops_base_url, cache_dir=None, max_workers=4, batch_size=100, retries=5, backoff_factor=1, timeout=120):
+        self.repository_id = repository_id
+        self.repositories_url = f"{base_url}/{repository_id}/diffs/commits"
+        self.cache_dir = cache_dir
+        self.max_workers = max(max_workers, 1)
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+
+        # Define the authentication token
+        self.authorization = str(base64.b64encode(bytes(':'+(access_token or ''), 'ascii')), 'ascii')
 
-    while True:
+        # Opened for the first request, a diff served from the cache does not even import requests
+        self.session = None
+
+    def open_session(self):
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        self.session = requests.Session()
+        self.session.headers.update({
+            'Content-type': 'application/json',
+            'Accept': 'application/json, text/javascript',
+            'Authorization': 'Basic '+self.authorization
+        })
+        retry = Retry(total=self.retries, backoff_factor=self.backoff_factor, status_forcelist=[429, 500, 502, 503, 504], raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_workers, max_retries=retry)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get_changes(self, base_version, target_version):
+        changes = self.read_cache(base_version, target_version)
+        if changes is not None:
+            print(f"Using cached diff between {base_version} and {target_version} - Changes Count: {len(changes)}")
+            return changes
+        changes = self.fetch_changes(base_version, target_version)
+        self.write_cache(base_version, target_version, changes)
+        print(f"Changes Count: {len(changes)}")
+        return changes
+
+    def get_page(self, base_version, target_version, skip):
         # Execute the git diff command using Azure DevOps API
-        diff_command_url = f"{repositories_url}?&$top={batch_size}&$skip={skip}&baseVersion={last_success_build_id}&baseVersionType=commit&targetVersion={current_head}&targetVersionType=commit&api-version-6.0"
-        changes_response = requests.get(diff_command_url, headers=headers)
-        changes_response.raise_for_status()
-        changes = changes_response.json().get("changes", [])
+        diff_command_url = f"{self.repositories_url}?&$top={self.batch_size}&$skip={skip}&baseVersion={base_version}&baseVersionType=commit&targetVersion={target_version}&targetVersionType=commit&api-version=6.0"
         print(f"Executing Azure API URL: {diff_command_url}")
-        # Extract the modified file paths
-        if len(changes) > 0:
-            print(f"Iterating while loop - Changes Count: {len(changes)}")
-            # changes_list = changes_response.json().get("changes", [])
-            if account_level_file == "0":
-                for change in changes:
-                    is_folder = (change['item']).get("isFolder", False)
-                    file_path = f"{root_directory}{change['item']['path']}"
-
-                    if pipeline_name.startswith('coedw_pipeline_'):
-                        # Skip Security folder if the CICD pipeline is coedw pipeline
-                        if change["changeType"] in ["add", "edit, rename", "rename"] and not is_folder and 'coEDW/Security/' not in file_path:
-                            incremental_changes_list.append(file_path)
-                        if ("/V_" not in file_path and "/v_" not in file_path) and not is_folder and 'coEDW/Security/' not in file_path:
-                            incremental_changes_list.append(file_path)
-                    else:
-                        # include all the scripts
-                        if change["changeType"] in ["add", "edit, rename", "rename"] and not is_folder:
-                            incremental_changes_list.append(file_path)
-                        if ("/V_" not in file_path and "/v_" not in file_path) and not is_folder:
-                            incremental_changes_list.append(file_path)
+        changes_response = self.session.get(diff_command_url, timeout=self.timeout)
+        changes_response.raise_for_status()
+        return changes_response.json().get("changes", [])
+
+    def fetch_changes(self, base_version, target_version):
+        # The page count is only known once a short page comes back, so after the first page
+        # the next max_workers pages are requested together until one of them is short
+        if self.session is None:
+            self.open_session()
+        changes = self.get_page(base_version, target_version, 0)
+        if len(changes) < self.batch_size:
+            return changes
+
+        skip = self.batch_size
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while True:
+                skips = [skip + page * self.batch_size for page in range(self.max_workers)]
+                for page_changes in executor.map(lambda page_skip: self.get_page(base_version, target_version, page_skip), skips):
+                    changes.extend(page_changes)
+                    if len(page_changes) < self.batch_size:
+                        print(f"Breaking the loop as batch size is less than the maximum batch size - {len(page_changes)}")
+                        return changes
+                skip = skips[-1] + self.batch_size
+
+    def get_cache_path(self, base_version, target_version):
+        return os.path.join(self.cache_dir, f"diff_{self.repository_id}_{base_version}_{target_version}.json")
+
+    def read_cache(self, base_version, target_version):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self.get_cache_path(base_version, target_version)) as cache_file:
+                return json.load(cache_file)["changes"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def write_cache(self, base_version, target_version, changes):
+        if not self.cache_dir:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Write to a temporary file first so a concurrent stage never reads a partial cache entry
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(file_descriptor, 'w') as cache_file:
+            json.dump({"repository_id": self.repository_id, "base": base_version, "target": target_version, "changes": changes}, cache_file)
+        os.replace(temporary_path, self.get_cache_path(base_version, target_version))
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+
+
+class GitChangeSource(ChangeSource):
+    # Computes the name-status diff from the local checkout, which every pipeline stage already has.
+    # Like the REST API it compares the common commit with the target (base...target) and detects renames.
+
+    # Git status letters mapped to the Azure DevOps change types
+    change_types = {'A': 'add', 'C': 'add', 'M': 'edit', 'T': 'edit', 'D': 'delete'}
+
+    def __init__(self, repository_dir, paths=None):
+        self.repository_dir = repository_dir
+        self.paths = paths or []
+
+    def get_changes(self, base_version, target_version):
+        command = ['git', '-C', self.repository_dir, 'diff', '--name-status', '-z', '-M', '--no-color', f'{base_version}...{target_version}', '--'] + self.paths
+        print(f"Executing git diff: {' '.join(command)}")
+        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            raise ValueError("git diff between %s and %s failed: %s" % (base_version, target_version, result.stderr.decode('utf-8', 'replace').strip()))
+
+        changes = []
+        fields = result.stdout.decode('utf-8').split('\0')
+        position = 0
+        while position < len(fields) and fields[position]:
+            status = fields[position]
+            if status[0] in 'RC':
+                # Renames and copies carry the old and the new path, a rename below 100% similarity was edited too
+                path = fields[position + 2]
+                position += 3
+            else:
+                path = fields[position + 1]
+                position += 2
+            if status[0] == 'R':
+                change_type = 'rename' if status == 'R100' else 'edit, rename'
+            else:
+                change_type = self.change_types.get(status[0], 'edit')
+            changes.append({'item': {'path': '/' + path, 'isFolder': False}, 'changeType': change_type})
+        print(f"Changes Count: {len(changes)}")
+        return changes
+
+
+class TimedChangeSource(ChangeSource):
+    # Wraps a change source to record the time spent getting the diff as the diff_fetch phase
+
+    def __init__(self, change_source, metrics):
+        self.change_source = change_source
+        self.metrics = metrics
+
+    def get_changes(self, base_version, target_version):
+        with self.metrics.phase('diff_fetch'):
+            return self.change_source.get_changes(base_version, target_version)
+
+    def close(self):
+        self.change_source.close()
+
+
+class SharedChangeSource(ChangeSource):
+    # Serves the diff of a commit range to all deployments of a batch, it is fetched once and kept in memory.
+    # The deployments' close() is ignored, the batch closes the wrapped source with close_shared()
+
+    def __init__(self, change_source):
+        self.change_source = change_source
+        self.changes = dict()
+        self.lock = threading.Lock()
+
+    def get_changes(self, base_version, target_version):
+        # Deployments asking for the same range meanwhile wait for the one fetch
+        with self.lock:
+            if (base_version, target_version) in self.changes:
+                print(f"Using the diff between {base_version} and {target_version} fetched for this batch")
+            else:
+                self.changes[(base_version, target_version)] = self.change_source.get_changes(base_version, target_version)
+            return self.changes[(base_version, target_version)]
+
+    def close(self):
+        pass
+
+    def close_shared(self):
+        self.change_source.close()
+
+
+class ScriptMetadataCache:
+    # Script details and rendered-content checksums per environment, kept on disk between runs of an agent. An
+    # entry is valid while the file keeps its mtime and size, the least recently used entries are evicted beyond
+    # max_entries. Checksums depend on the environment configuration, they are dropped when its fingerprint changes.
+
+    def __init__(self, cache_file, max_entries=50000, fingerprint=None):
+        self.cache_file = cache_file
+        self.max_entries = max(max_entries, 1)
+        self.fingerprint = fingerprint
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.changed = False
+        self.load()
+
+    def read_entries(self):
+        try:
+            with open(self.cache_file) as cache_file:
+                cache = json.load(cache_file)
+            entries = cache['entries']
+        except (OSError, ValueError, KeyError):
+            return []
+        if cache.get('fingerprint') != self.fingerprint:
+            for path, entry in entries:
+                entry['checksums'] = dict()
+        return entries
+
+    def load(self):
+        for path, entry in self.read_entries():
+            self.entries[path] = entry
+
+    def merge_saved_entries(self):
+        # Runs for other environments may have saved the cache since it was loaded, their entries and checksums
+        # are kept unless this run has a newer version of the file
+        for path, saved_entry in self.read_entries():
+            entry = self.entries.get(path)
+            if entry is None:
+                if len(self.entries) < self.max_entries:
+                    self.entries[path] = saved_entry
+                    self.entries.move_to_end(path, last=False)
+            elif entry['mtime_ns'] == saved_entry['mtime_ns'] and entry['size'] == saved_entry['size']:
+                entry['checksums'] = dict(saved_entry['checksums'], **entry['checksums'])
+                if entry['details'] is None:
+                    entry['details'] = saved_entry['details']
+
+    def save(self):
+        with self.lock:
+            if not self.changed:
+                return
+            self.merge_saved_entries()
+            directory = os.path.dirname(os.path.abspath(self.cache_file))
+            os.makedirs(directory, exist_ok=True)
+            # Written next to the cache and moved in place, so a concurrent run never reads a partial file
+            file_descriptor, temporary_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            with os.fdopen(file_descriptor, 'w') as cache_file:
+                json.dump({'fingerprint': self.fingerprint, 'entries': list(self.entries.items())}, cache_file)
+            os.replace(temporary_path, self.cache_file)
+            self.changed = False
+        print(f"Script metadata cache: {self.hits} hit(s), {self.misses} miss(es), {len(self.entries)} entries saved to {self.cache_file}")
+
+    def get_entry(self, path, create=False):
+        # The entry of the file as it is on disk now, None when it is unknown or the file changed since
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry['mtime_ns'] == stat.st_mtime_ns and entry['size'] == stat.st_size:
+                # A hit only moves the entry in the recency order, which is saved along with the next change. A run
+                # that only reads the cache does not rewrite the file
+                self.entries.move_to_end(path)
+                return entry
+            if not create:
+                return None
+            entry = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'details': None, 'checksums': dict()}
+            self.entries[path] = entry
+            self.entries.move_to_end(path)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self.changed = True
+            return entry
+
+    def count(self, found):
+        with self.lock:
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get_details(self, path):
+        entry = self.get_entry(path)
+        details = entry['details'] if entry is not None else None
+        self.count(details is not None)
+        return dict(details) if details is not None else None
+
+    def put_details(self, path, details):
+        entry = self.get_entry(path, create=True)
+        if entry is not None:
+            with self.lock:
+                if entry['details'] != details:
+                    entry['details'] = dict(details)
+                    self.changed = True
+
+    def get_checksum(self, path, database_environment):
+        entry = self.get_entry(path)
+        checksum = entry['checksums'].get(database_environment) if entry is not None else None
+        self.count(checksum is not None)
+        return checksum
+
+    def put_checksum(self, path, database_environment, checksum):
+        entry = self.get_entry(path, create=True)
+        if entry is not None:
+            with self.lock:
+                if entry['checksums'].get(database_environment) != checksum:
+                    entry['checksums'][database_environment] = checksum
+                    self.changed = True
+
+
+class DeploymentCheckpoint:
+    # Scripts applied by a build, one JSON line per script appended as soon as the script succeeded. A rerun of
+    # the same build, commit, pipeline and database resumes after them, also when CHANGE_HISTORY rows were still
+    # waiting to be written when the run stopped. The file is removed once the deployment completed.
+
+    def __init__(self, checkpoint_file, build_id, current_head, pipeline_name, database):
+        self.checkpoint_file = checkpoint_file
+        self.header = {'build_id': build_id, 'current_head': current_head, 'pipeline_name': pipeline_name, 'database': database}
+        self.entries = dict()
+        self.lock = threading.Lock()
+        self.file = None
+
+    def load(self):
+        # The scripts already applied, nothing when the file belongs to another build or commit
+        try:
+            with open(self.checkpoint_file) as checkpoint_file:
+                lines = [json.loads(line) for line in checkpoint_file if line.strip()]
+        except FileNotFoundError:
+            return dict()
+        except (OSError, ValueError) as error:
+            print(f"Ignoring unreadable checkpoint {self.checkpoint_file}: {error}")
+            return dict()
+        if not lines or lines[0] != self.header:
+            print(f"Ignoring checkpoint {self.checkpoint_file}, it was written for another build")
+            return dict()
+        self.entries = {entry['script_path']: entry for entry in lines[1:]}
+        return dict(self.entries)
+
+    def open(self):
+        # Continues a loaded checkpoint, anything else is replaced
+        directory = os.path.dirname(os.path.abspath(self.checkpoint_file))
+        os.makedirs(directory, exist_ok=True)
+        if self.entries:
+            self.file = open(self.checkpoint_file, 'a')
+        else:
+            self.file = open(self.checkpoint_file, 'w')
+            self.write(self.header)
+
+    def write(self, line):
+        self.file.write(json.dumps(line) + '\n')
+        self.file.flush()
+
+    def record(self, script_path, checksum, execution_time, query_ids=None):
+        with self.lock:
+            if self.file is None or script_path in self.entries:
+                return
+            entry = {'script_path': script_path, 'checksum': checksum, 'execution_time': execution_time, 'query_ids': list(query_ids) if query_ids else None}
+            self.entries[script_path] = entry
+            self.write(entry)
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def remove(self):
+        self.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.checkpoint_file)
+
+
+class RunMetrics:
+    # Time spent in every phase of a run and per script, measured with perf_counter. Phases may be entered from
+    # several threads and more than once, each keeps its count, total and longest time. The report is written as
+    # JSON or in the Prometheus textfile format
+
+    def __init__(self, labels=None):
+        self.labels = labels or dict()
+        self.phases = dict()
+        self.scripts = []
+        self.counters = dict()
+        self.slowest_scripts = []
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.perf_counter() - start)
+
+    def add_phase(self, name, seconds):
+        with self.lock:
+            count, total, longest = self.phases.get(name, (0, 0.0, 0.0))
+            self.phases[name] = (count + 1, total + seconds, max(longest, seconds))
+
+    def add_script(self, script, status, **seconds):
+        with self.lock:
+            self.scripts.append(dict(script=script.script_full_path, script_type=script.script_type, status=status, **seconds))
+
+    def set_counter(self, name, value):
+        with self.lock:
+            self.counters[name] = value
+
+    def report(self):
+        with self.lock:
+            return {
+                'labels': dict(self.labels),
+                'phases': {name: {'count': count, 'seconds': total, 'max_seconds': longest} for name, (count, total, longest) in self.phases.items()},
+                'counters': dict(self.counters),
+                'scripts': list(self.scripts),
+                'slowest_scripts': list(self.slowest_scripts)
+            }
+
+    def to_prometheus(self):
+        report = self.report()
+
+        def label(key, value):
+            # Backslashes, double quotes and line feeds are escaped in label values of the exposition format
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            return f'{key}="{value}"'
+
+        labels = ",".join(label(key, value) for key, value in sorted(report['labels'].items()) if value is not None)
+
+        def metric_labels(**extra):
+            extra_labels = ",".join(label(key, value) for key, value in extra.items())
+            return "{" + ",".join(part for part in [labels, extra_labels] if part) + "}"
+
+        lines = ["# HELP snowchange_phase_seconds Seconds spent in a phase of the deployment run",
+                 "# TYPE snowchange_phase_seconds gauge"]
+        lines += [f"snowchange_phase_seconds{metric_labels(phase=name)} {phase['seconds']:.6f}" for name, phase in report['phases'].items()]
+        lines += ["# HELP snowchange_phase_count Number of times a phase ran",
+                  "# TYPE snowchange_phase_count gauge"]
+        lines += [f"snowchange_phase_count{metric_labels(phase=name)} {phase['count']}" for name, phase in report['phases'].items()]
+        for name, value in report['counters'].items():
+            lines += [f"# TYPE snowchange_{name} gauge", f"snowchange_{name}{metric_labels()} {value}"]
+        return "\n".join(lines) + "\n"
+
+    def write(self, metrics_file, metrics_format='json'):
+        # Written next to the target and moved in place, a textfile collector never reads half a file
+        temporary_path = metrics_file + '.tmp'
+        with open(temporary_path, 'w') as f:
+            if metrics_format == 'prometheus':
+                f.write(self.to_prometheus())
+            else:
+                json.dump(self.report(), f, indent=2)
+        os.replace(temporary_path, metrics_file)
+        print(f"Run metrics written to {metrics_file}")
+
+
+def get_incremental_changes_list(current_head, last_success_build_id, root_directory, access_token, repository_id, account_level_file, pipeline_name, change_source=None):
+    if change_source is None:
+        # A client opened here is closed again once the diff is fetched
+        with contextlib.closing(AzureDevOpsDiffClient(access_token, repository_id)) as diff_client:
+            changes = diff_client.get_changes(last_success_build_id, current_head)
+    else:
+        changes = change_source.get_changes(last_success_build_id, current_head)
+    return filter_incremental_changes(changes, root_directory, account_level_file, pipeline_name)
+
+
+def filter_incremental_changes(changes, root_directory, account_level_file, pipeline_name):
+    # A dict keeps the diff order while recording each path once, even when several conditions match it
+    incremental_changes = dict()
+    # Extract the modified file paths
+    if account_level_file == "0":
+        for change in changes:
+            is_folder = (change['item']).get("isFolder", False)
+            file_path = f"{root_directory}{change['item']['path']}"
+
+            if pipeline_name.startswith('coedw_pipeline_'):
+                # Skip Security folder if the CICD pipeline is coedw pipeline
+                if change["changeType"] in ["add", "edit, rename", "rename"] and not is_folder and 'coEDW/Security/' not in file_path:
+                    incremental_changes[file_path] = None
+                if ("/V_" not in file_path and "/v_" not in file_path) and not is_folder and 'coEDW/Security/' not in file_path:
+                    incremental_changes[file_path] = None
             else:
-                for change in changes:
-                    is_folder = (change['item']).get("isFolder", False)
-                    if change["changeType"] in ["add", "edit, rename", "rename"] and not is_folder:
-                        file = f"{root_directory}{change['item']['path']}"
-                        if "/coEDW/post_prod_deployment/" not in file:
-                            continue
-                        incremental_changes_list.append(file)
-        # Break the loop if the batch size is less than the maximum batch size
-        if len(changes) < batch_size:
-            print(f"Breaking the loop as batch size is less than the maximum batch size - {len(changes)}")
-            return incremental_changes_list
-
-        # Increment the skip value for the next batch
-        skip += batch_size
-
-
-def get_modified_files(current_head, snowflake_connection, autocommit, verbose, buildid_info_table, last_success_build_id, execute_snowflake_query, root_directory, access_token, orderfile, repository_id, pipeline_name, account_level_file='0', folder_path=None):
+                # include all the scripts
+                if change["changeType"] in ["add", "edit, rename", "rename"] and not is_folder:
+                    incremental_changes[file_path] = None
+                if ("/V_" not in file_path and "/v_" not in file_path) and not is_folder:
+                    incremental_changes[file_path] = None
+    else:
+        for change in changes:
+            is_folder = (change['item']).get("isFolder", False)
+            if change["changeType"] in ["add", "edit, rename", "rename"] and not is_folder:
+                file = f"{root_directory}{change['item']['path']}"
+                if "/coEDW/post_prod_deployment/" not in file:
+                    continue
+                incremental_changes[file] = None
+    return list(incremental_changes)
+
+
+def get_modified_files(current_head, snowflake_connection, autocommit, verbose, buildid_info_table, last_success_build_id, execute_snowflake_query, root_directory, access_token, orderfile, repository_id, pipeline_name, account_level_file='0', folder_path=None, root_depth=9, change_source=None, metadata_cache=None):
     order_list = []
     incremental_changes_list = []
     if orderfile is not None:
@@ -89,57 +535,56 @@ def get_modified_files(current_head, snowflake_connection, autocommit, verbose,
     print(f"current_head: {current_head}")
     print(f"account_level_file value: {account_level_file}")
 
-    incremental_changes_list = get_incremental_changes_list(current_head, last_success_build_id, root_directory, access_token, repository_id, account_level_file, pipeline_name)
+    incremental_changes_list = get_incremental_changes_list(current_head, last_success_build_id, root_directory, access_token, repository_id, account_level_file, pipeline_name, change_source)
 
-    all_v_files = dict()
-    all_r_files = dict()
-    all_r_files_2 = dict()
+    script_catalog = ScriptCatalog()
     allnewfiles = dict()
-    i = 0
-    # Traverse the entire directory structure recursively
+    # Only the changed paths are looked at, the checkout itself is never walked
     if folder_path is not None:
-        for (directory_path, directory_names, file_names) in os.walk(root_directory):
-            for file_name in file_names:
-                if not file_name.endswith('.sql'):
-                    continue
-                file_full_path = os.path.join(directory_path, file_name)
-                if file_full_path not in incremental_changes_list:
-                    continue
-                if account_level_file == "0":
-                    if re.compile(folder_path).search(file_full_path) is None:
-                        continue
-                elif account_level_file == "3":
-                    if re.compile("/post_prod_deployment/").search(file_full_path) is None:
-                        continue
-                allnewfiles[file_full_path] = file_name
-
-    new_order_len = None
-    for order in order_list:
+        if account_level_file == "0":
+            path_filter = re.compile(folder_path).search
+        elif account_level_file == "3":
+            path_filter = post_prod_deployment_pattern.search
+        else:
+            path_filter = None
+        allnewfiles = discover_changed_scripts(incremental_changes_list, path_filter)
+
+    # Classify every file with one lookup of its folder (the path below root_depth without the file name)
+    order_index = compile_order_index(order_list)
+    ordered_files = []
+    other_files = []
+    for file in allnewfiles:
+        script = get_details(file, allnewfiles[file], metadata_cache)
+        tier = order_index.get(tuple(file.split("/")[root_depth:-1]))
+        if tier is None:
+            other_files.append(script)
+        else:
+            # Remember which order-file line matched, scripts of the same tier may be applied together
+            script.script_tier = tier
+            ordered_files.append(script)
+
+    # Sorting is stable, files of one tier keep their discovery order
+    ordered_files.sort(key=lambda script: script.script_tier)
+    for script in ordered_files:
+        script_catalog.add(script, ordered=True)
+    for script in other_files:
+        script_catalog.add(script, ordered=False)
+    return script_catalog
+
+
+def compile_order_index(order_list):
+    # Order file lines keyed by their folder tuple, the first line of a folder decides its tier
+    order_index = dict()
+    for tier, order in enumerate(order_list):
+        order = order.strip()
         if order.endswith("/"):
             order = order[:-1]
-        new_order = order.split("/")
-        new_order_len = len(new_order)
-        for file in allnewfiles:
-            new_file = file.split("/")
-            del new_file[0:9]
-            if new_file:
-                new_file.pop()
-            len_file = len(new_file)
-
-            script = get_details(file, allnewfiles[file])
-            if new_order_len == len_file and new_order == new_file:
-                all_v_files[i] = script
-                i = i + 1
-            else:
-                all_r_files_2[file] = script
-    for i in all_v_files:
-        if all_v_files[i]["script_full_path"] in all_r_files_2:
-            del all_r_files_2[all_v_files[i]["script_full_path"]]
-    all_r_files = all_r_files_2
-    return all_v_files, all_r_files
+        if order:
+            order_index.setdefault(tuple(order.split("/")), tier)
+    return order_index
 
 
-def get_account_modified_files(current_head, snowflake_connection, autocommit, verbose, buildid_info_table, last_success_build_id, execute_snowflake_query, root_directory, access_token, repository_id, pipeline_name, account_level_file='0'):
+def get_account_modified_files(current_head, snowflake_connection, autocommit, verbose, buildid_info_table, last_success_build_id, execute_snowflake_query, root_directory, access_token, repository_id, pipeline_name, account_level_file='0', change_source=None, metadata_cache=None):
 
     # build_numbers = getBuildInfo(snowflake_connection, autocommit, verbose, buildid_info_table, execute_snowflake_query)
     # if len(build_numbers) != 0:
@@ -151,65 +596,277 @@ def get_account_modified_files(current_head, snowflake_connection, autocommit, v
     print(f"current_head: {current_head}")
     print(f"account_level_file value: {account_level_file}")
 
-    incremental_changes_file = get_incremental_changes_list(current_head, last_success_build_id, root_directory, access_token, repository_id, account_level_file, pipeline_name)
+    incremental_changes_list = get_incremental_changes_list(current_head, last_success_build_id, root_directory, access_token, repository_id, account_level_file, pipeline_name, change_source)
 
-    incremental_changes_list = []
+    script_catalog = ScriptCatalog()
+    for file_full_path, file_name in discover_changed_scripts(incremental_changes_list).items():
+        script = get_details(file_full_path, file_name, metadata_cache)
+        script_catalog.add(script, ordered=script.script_type == 'V')
 
-    if incremental_changes_file is not None:
-        with open(incremental_changes_file) as f:
-            for line in f:
-                incremental_changes_list.append(line.strip())
+    return script_catalog
 
-    all_v_files = dict()
-    all_r_files = dict()
 
-    # Walk the entire directory structure recursively
-    for (directory_path, directory_names, file_names) in os.walk(root_directory):
-        for file_name in file_names:
-            if not file_name.endswith('.sql'):
-                continue
+post_prod_deployment_pattern = re.compile("/post_prod_deployment/")
 
-            file_full_path = os.path.join(directory_path, file_name)
-            file_modified_time = datetime.fromtimestamp(os.path.getmtime(file_full_path)).strftime('%Y%m%d%H%M%S%f')
 
-            if not(file_full_path in incremental_changes_list):
-                continue
+def discover_changed_scripts(incremental_changes_list, path_filter=None):
+    # Maps the full path of every changed .sql script that still exists to its file name, in diff order
+    changed_scripts = dict()
+    for file_full_path in incremental_changes_list:
+        if not file_full_path.endswith('.sql'):
+            continue
+        if path_filter is not None and path_filter(file_full_path) is None:
+            continue
+        # Deleted scripts are part of the diff as well
+        if not os.path.isfile(file_full_path):
+            continue
+        changed_scripts[file_full_path] = os.path.basename(file_full_path)
+    return changed_scripts
 
-            script_name_parts = re.search(r'^([Vv])_(.+)\.sql$', file_name.strip())
 
-            # Add this script to our dictionary (as nested dictionary)
-            script = dict()
-            script['script_name'] = file_name
-            script['script_full_path'] = file_full_path
-            script['script_type'] = 'R' if script_name_parts is None else 'V'
-            script['script_description'] = (os.path.splitext(file_name)[0] if script_name_parts is None else script_name_parts.group(2)).replace('_', ' ').capitalize()
-            script['script_modified_time'] = file_modified_time
+class ScriptRecord:
+    # One changed script. Slots keep the records of very large change sets small, environments are the tags of
+    # the file name ((DEV), (TST), ...) or None for scripts of every environment, script_tier the order-file line
+    # or dependency wave the script belongs to
 
-            if script['script_type'] == 'V':
-                all_v_files[file_full_path] = script
-            else:
-                all_r_files[file_full_path] = script
+    __slots__ = ('script_name', 'script_full_path', 'script_type', 'script_description', 'script_modified_time', 'script_tier', 'environments')
+
+    def __init__(self, script_name, script_full_path, script_type, script_description, script_modified_time, script_tier=None):
+        self.script_name = script_name
+        self.script_full_path = script_full_path
+        self.script_type = script_type
+        self.script_description = script_description
+        self.script_modified_time = script_modified_time
+        self.script_tier = script_tier
+        environments = extract_env(script_name)
+        self.environments = tuple(environments) if environments else None
+
+    def get_details(self):
+        # What get_details derives from the file, as stored in the metadata cache
+        return {'script_name': self.script_name, 'script_full_path': self.script_full_path, 'script_type': self.script_type, 'script_description': self.script_description, 'script_modified_time': self.script_modified_time}
+
+    def is_for_environment(self, database_environment):
+        return self.environments is None or database_environment in self.environments
+
+    def __repr__(self):
+        return f"ScriptRecord({self.script_full_path!r}, type={self.script_type}, tier={self.script_tier})"
+
+
+class ScriptCatalog:
+    # The changed scripts of a run. v_scripts are applied first in their order (the scripts of order-file folders,
+    # or the V scripts of the account level), r_scripts after them. An index by path makes lookups cheap. A
+    # dependency plan replaces the apply order with set_apply_order().
+
+    def __init__(self):
+        self.v_scripts = []
+        self.r_scripts = []
+        self.apply_order = None
+        self.by_path = dict()
+
+    def add(self, script, ordered):
+        (self.v_scripts if ordered else self.r_scripts).append(script)
+        self.by_path[script.script_full_path] = script
+
+    def get(self, script_full_path):
+        return self.by_path.get(script_full_path)
 
-    return all_v_files, all_r_files
+    def set_apply_order(self, scripts):
+        self.apply_order = list(scripts)
+        self.by_path = {script.script_full_path: script for script in self.apply_order}
 
+    def __iter__(self):
+        if self.apply_order is not None:
+            yield from self.apply_order
+            return
+        yield from self.v_scripts
+        yield from self.r_scripts
 
-def get_details(full_file_path, file_name):
+    def __len__(self):
+        return len(self.v_scripts) + len(self.r_scripts)
+
+    def __contains__(self, script_full_path):
+        return script_full_path in self.by_path
+
+
+def get_details(full_file_path, file_name, metadata_cache=None):
     try:
+        if metadata_cache is not None:
+            details = metadata_cache.get_details(full_file_path)
+            if details is not None:
+                return ScriptRecord(**details)
+
         file_modified_time = datetime.fromtimestamp(os.path.getmtime(full_file_path)).strftime('%Y%m%d%H%M%S%f')
         script_name_parts = re.search(r'^([Vv])_(.+)\.sql$', file_name.strip())
 
-        # Add this script to our dictionary (as nested dictionary)
-        script = dict()
-        script['script_name'] = file_name
-        script['script_full_path'] = full_file_path
-        script['script_type'] = 'R' if script_name_parts is None else 'V'
-        script['script_description'] = (os.path.splitext(file_name)[0] if script_name_parts is None else script_name_parts.group(2)).replace('_', ' ').capitalize()
-        script['script_modified_time'] = file_modified_time
+        script_type = 'R' if script_name_parts is None else 'V'
+        script_description = (os.path.splitext(file_name)[0] if script_name_parts is None else script_name_parts.group(2)).replace('_', ' ').capitalize()
+        script = ScriptRecord(file_name, full_file_path, script_type, script_description, file_modified_time)
+        if metadata_cache is not None:
+            metadata_cache.put_details(full_file_path, script.get_details())
         return script
     except Exception as error:
         return error
 
 
+# Comments and string literals are blanked out before looking for object names, so commented out code is ignored.
+# $$ bodies are kept on purpose, the objects a procedure touches are dependencies as well.
+sql_noise_pattern = re.compile(r"--[^\n]*|//[^\n]*|/\*.*?\*/|'(?:[^'\\]|\\.)*'", re.DOTALL)
+sql_identifier = r'(?:"[^"]+"|[A-Za-z_][\w$]*)'
+sql_created_object_pattern = re.compile(
+    r'\bCREATE\s+(?:OR\s+REPLACE\s+)?(?:(?:SECURE|TRANSIENT|TEMPORARY|TEMP|LOCAL|GLOBAL|VOLATILE|RECURSIVE|MATERIALIZED|EXTERNAL|DYNAMIC)\s+)*'
+    r'(?:TABLE|VIEW|PROCEDURE|FUNCTION|SEQUENCE|STREAM|TASK|STAGE|FILE\s+FORMAT|PIPE|TAG|MASKING\s+POLICY|ROW\s+ACCESS\s+POLICY)\s+'
+    r'(?:IF\s+NOT\s+EXISTS\s+)?(' + sql_identifier + r'(?:\s*\.\s*' + sql_identifier + r'){0,2})', re.IGNORECASE)
+sql_qualified_name_pattern = re.compile(r'(?<![\w$."])(' + sql_identifier + r'\s*\.\s*' + sql_identifier + r'\s*\.\s*' + sql_identifier + r')(?![\w$"])')
+
+
+def normalize_object_name(name, database_aliases=None):
+    # Unquoted identifiers are case insensitive in Snowflake, environment specific database names are folded
+    # into one name so COEDW_DEV.DBO.X and COEDW.DBO.X are treated as the same object
+    parts = []
+    for part in re.findall(r'"[^"]+"|[^.\s]+', name):
+        parts.append(part[1:-1] if part.startswith('"') else part.upper())
+    if database_aliases and len(parts) == 3:
+        parts[0] = database_aliases.get(parts[0], parts[0])
+    return tuple(parts)
+
+
+def extract_object_references(content, database_aliases=None):
+    # Returns the objects a script creates and the DB.SCHEMA.OBJECT names it references
+    code = sql_noise_pattern.sub(' ', content)
+    created = set()
+    for match in sql_created_object_pattern.finditer(code):
+        created.add(normalize_object_name(match.group(1), database_aliases))
+    referenced = set()
+    for match in sql_qualified_name_pattern.finditer(code):
+        referenced.add(normalize_object_name(match.group(1), database_aliases))
+    return created, referenced - created
+
+
+def build_dependency_plan(scripts, database_aliases=None):
+    # Orders the scripts by the objects they create and reference and groups them into waves,
+    # scripts of one wave do not depend on each other and can be applied concurrently
+    creators = dict()
+    references = []
+    for script in scripts:
+        with open(script.script_full_path, 'r') as content_file:
+            created, referenced = extract_object_references(content_file.read(), database_aliases)
+        for name in created:
+            creators.setdefault(name, []).append(script.script_full_path)
+            # Objects created with a partial name can still satisfy fully qualified references
+            if len(name) == 2:
+                creators.setdefault(('*',) + name, []).append(script.script_full_path)
+        references.append(referenced)
+
+    position = dict((script.script_full_path, index) for index, script in enumerate(scripts))
+    dependencies = dict((script.script_full_path, set()) for script in scripts)
+    unresolved = dict()
+    previous_v_script = None
+    for script, referenced in zip(scripts, references):
+        path = script.script_full_path
+        for name in referenced:
+            providers = creators.get(name) or creators.get(('*',) + name[1:])
+            if providers:
+                dependencies[path].update(provider for provider in providers if provider != path)
+            else:
+                unresolved.setdefault(path, []).append('.'.join(name))
+        # Versioned scripts keep their relative order, whatever they reference
+        if script.script_type == 'V':
+            if previous_v_script is not None:
+                dependencies[path].add(previous_v_script)
+            previous_v_script = path
+
+    for path in sorted(unresolved, key=position.get):
+        print(f"Unresolved references in {path} (expected to exist already): {', '.join(sorted(unresolved[path]))}")
+
+    # Kahn's algorithm, one wave per level so independent branches end up side by side
+    remaining = dict((path, set(required)) for path, required in dependencies.items())
+    waves = []
+    while remaining:
+        ready = sorted([path for path, required in remaining.items() if not required], key=position.get)
+        if not ready:
+            raise ValueError("Dependency cycle between change scripts: %s" % ' -> '.join(find_dependency_cycle(remaining)))
+        for path in ready:
+            del remaining[path]
+        for required in remaining.values():
+            required.difference_update(ready)
+        waves.append([scripts[position[path]] for path in ready])
+
+    for tier, wave in enumerate(waves):
+        for script in wave:
+            script.script_tier = tier
+    return waves
+
+
+def find_dependency_cycle(dependencies):
+    # Walks the unresolved dependencies until a script repeats, which is always possible when no script is ready
+    path = next(iter(sorted(dependencies)))
+    visited = []
+    while path not in visited:
+        visited.append(path)
+        path = sorted(dependencies[path])[0]
+    return visited[visited.index(path):] + [path]
+
+
+# What ends the current state of the statement splitter: a quote, a $$ block or a comment starts a state, the
+# statement ends at a ; outside all of them
+sql_split_patterns = {
+    None: re.compile(r"'|\"|\$\$|--|//|/\*|;"),
+    "'": re.compile(r"\\.|''|'", re.DOTALL),
+    '"': re.compile(r'""|"'),
+    "$$": re.compile(r"\$\$"),
+    "--": re.compile(r"\n"),
+    "/*": re.compile(r"\*/"),
+}
+sql_comment_pattern = re.compile(r"--[^\n]*|//[^\n]*|/\*.*?\*/", re.DOTALL)
+
+
+def split_sql_statements(chunks):
+    # Lazily splits SQL text arriving in chunks into statements, every statement with its terminating ; and the
+    # text before it. Joining the statements gives back the input, only one statement is held in memory at a time
+    buffer = ""
+    start = 0
+    pos = 0
+    state = None
+    chunks = iter(chunks)
+    eof = False
+    while not eof:
+        chunk = next(chunks, None)
+        if chunk is None:
+            eof = True
+        else:
+            buffer = buffer[start:] + chunk
+            pos -= start
+            start = 0
+
+        while True:
+            match = sql_split_patterns[state].search(buffer, pos)
+            # A token at the very end may continue in the next chunk ('' inside a string, "" inside an identifier)
+            if not match or (match.end() == len(buffer) and not eof):
+                # Keep the last character, it may be the first half of a two character token
+                pos = max(pos, len(buffer) - 1) if not match else match.start()
+                break
+            token = match.group()
+            pos = match.end()
+            if state is None:
+                if token == ";":
+                    yield buffer[start:pos]
+                    start = pos
+                else:
+                    state = token if token != "//" else "--"
+            elif token in ("''", '""') or token.startswith("\\"):
+                continue
+            else:
+                state = None
+
+    if start < len(buffer):
+        yield buffer[start:]
+
+
+def is_executable_statement(statement):
+    # Statements holding nothing but comments and whitespace are not sent to Snowflake
+    return sql_comment_pattern.sub("", statement).strip().rstrip(";").strip() != ""
+
+
 def getBuildInfo(snowflake_connection, autocommit, verbose, buildid_info_table, execute_snowflake_query):
 
     qry_build_info_tables = "SELECT SUCCESSFUL_BUILD_ID FROM {0}.{1}.{2} ORDER BY DATE DESC;".format(buildid_info_table['database_name'], buildid_info_table['schema_name'], buildid_info_table['buildinfo_table_name'])
@@ -229,81 +886,221 @@ def extract_env(script_name):  # Function to extract the env from the script_nam
         return None
 
 
-def replace_warehouse_name(content, env_dict_warehouse, database_environment):
-    # Get environment-specific mapping dictionary
-    env_mapping = env_dict_warehouse.get(database_environment, {})
+def get_environment_database(env_config, snowflake_database, database_environment):
+    # The database of the environment in the family of snowflake_database, e.g. COEDW_DEV and tst give COEDW_TEST
+    for family in env_config['database_families']:
+        if snowflake_database.upper() in family['databases']:
+            if database_environment not in family['environments']:
+                raise ValueError(f"No {database_environment} database is configured for {snowflake_database}")
+            return family['environments'][database_environment]
+    raise ValueError(f"Database {snowflake_database} is not part of a database family in the environment configuration")
+
+
+def load_env_config(config_file):
+    # Database families, warehouse and stage mappings of every environment
+    with open(config_file, 'r') as f:
+        env_config = json.load(f)
+    for key in ['database_families', 'warehouses', 'stage_source_database', 'stages', 'exclude_files']:
+        if key not in env_config:
+            raise ValueError(f"Missing {key} in environment config {config_file}")
+    return env_config
+
 
-    # Regex pattern for all variants of WAREHOUSE assignment
-    pattern = r'(?i)(WAREHOUSE\s*=\s*)(\w+)'
+class EnvironmentRewriter:
+    # Rewrites the database names and warehouse assignments of a script for one environment. The database families
+    # and warehouse mapping are compiled once per environment into the list of names to replace and one regex, the
+    # output is the same as replacing every family in turn and then every WAREHOUSE = <name> assignment.
 
-    # Replacement function
-    def replace_match(match):
+    warehouse_pattern = re.compile(r'(?i)(WAREHOUSE\s*=\s*)(\w+)')
+
+    def __init__(self, env_config, database_environment):
+        if database_environment and database_environment.strip() != "":
+            database_environment = database_environment.strip()
+        self.database_environment = database_environment
+        self.warehouse_mapping = env_config['warehouses'].get(database_environment, {})
+
+        # Every other database name of a family is rewritten to the name of the family in this environment
+        self.database_replacements = []
+        for family in env_config['database_families']:
+            env_db_replace = family['environments'].get(database_environment) if database_environment and database_environment.strip() != "" else ""
+            if not env_db_replace or env_db_replace.strip() == "":
+                continue
+            for env_db in family['databases']:
+                if env_db != env_db_replace and env_db not in family.get('exclude_sources', []):
+                    self.database_replacements.append((f"{env_db}.", f"{env_db_replace.strip()}.", f"replace_env()- {env_db} exists, replaced with {env_db_replace}"))
+
+    def replace_warehouse(self, match, messages):
         prefix, warehouse_name = match.groups()
         warehouse_name = warehouse_name.strip()
-        mapped_name = env_mapping.get(warehouse_name)
+        mapped_name = self.warehouse_mapping.get(warehouse_name)
 
         if mapped_name:
             if warehouse_name != mapped_name:
-                print(f'Replacing "{warehouse_name}" → "{mapped_name}" for env "{database_environment}"')
+                messages.append(f'Replacing "{warehouse_name}" → "{mapped_name}" for env "{self.database_environment}"')
                 return f'{prefix}{mapped_name}'
             else:
-                print(f'No change needed: "{warehouse_name}" already correct for env "{database_environment}"')
+                messages.append(f'No change needed: "{warehouse_name}" already correct for env "{self.database_environment}"')
         else:
-            print(f'No mapping found for "{warehouse_name}" in env "{database_environment}"')
+            messages.append(f'No mapping found for "{warehouse_name}" in env "{self.database_environment}"')
         return match.group(0)
 
-    # Replace all warehouse names using replacement function
-    updated_content = re.sub(pattern, replace_match, content)
-    return updated_content
-
-
-def update_warehouse_size(user, account, role, warehouse, database, authenticator, password, deployment_warehouse_size):
-    conn = snowflake.connector.connect(
-        user=user,
-        account=account,
-        role=role,
-        warehouse=warehouse,
-        database=database,
-        authenticator=authenticator,
-        password=password
-        )
-    cursor = conn.cursor()
-
-    cursor.execute(f"SHOW WAREHOUSES LIKE '{warehouse}'")
-    warehouse_info = cursor.fetchone()
-    current_warehouse_size = warehouse_info[3]
+    def rewrite(self, content, messages=None):
+        # Messages are logged unless a dict is given to collect them, a script rewritten statement by statement
+        # collects them so every replacement is reported once
+        rewrite_messages = []
+
+        # The string is only copied for the names it actually contains
+        for env_db, env_db_replace, message in self.database_replacements:
+            if env_db in content:
+                content = content.replace(env_db, env_db_replace)
+                rewrite_messages.append(message)
+
+        # Most scripts do not set a warehouse, skip the case insensitive regex scan for those
+        if "warehouse" in content.casefold():
+            content = self.warehouse_pattern.sub(lambda match: self.replace_warehouse(match, rewrite_messages), content)
+
+        if messages is None:
+            for message in rewrite_messages:
+                logger.debug(message)
+        else:
+            messages.update(dict.fromkeys(rewrite_messages))
+        return content
+
+
+# Warehouse sizes from smallest to largest, every step doubles the compute and the credits per hour
+warehouse_sizes = ["X-SMALL", "SMALL", "MEDIUM", "LARGE", "X-LARGE", "2X-LARGE", "3X-LARGE", "4X-LARGE", "5X-LARGE", "6X-LARGE"]
+warehouse_size_aliases = {"XSMALL": "X-SMALL", "XLARGE": "X-LARGE", "XXLARGE": "2X-LARGE", "X2LARGE": "2X-LARGE", "XXXLARGE": "3X-LARGE", "X3LARGE": "3X-LARGE", "X4LARGE": "4X-LARGE", "X5LARGE": "5X-LARGE", "X6LARGE": "6X-LARGE"}
+
+
+def normalize_warehouse_size(size):
+    # SHOW WAREHOUSES returns X-Small, configurations use XSMALL or SMALL
+    size = size.strip().upper().replace(" ", "")
+    return warehouse_size_aliases.get(size, size)
+
+
+def get_warehouse_size(snowflake_connection, warehouse):
+    cursor = snowflake_connection.cursor()
+    try:
+        cursor.execute(f"SHOW WAREHOUSES LIKE '{warehouse}'")
+        return cursor.fetchone()[3]
+    finally:
+        cursor.close()
+
+
+def update_warehouse_size(snowflake_connection, warehouse, deployment_warehouse_size):
+    current_warehouse_size = get_warehouse_size(snowflake_connection, warehouse)
     print(f"Current warehouse size: {current_warehouse_size}, deployment warehouse size: {deployment_warehouse_size}")
 
-    if current_warehouse_size.lower() != deployment_warehouse_size.lower():
-        cursor.execute(f"ALTER WAREHOUSE {warehouse} SET WAREHOUSE_SIZE = {deployment_warehouse_size.upper()}")
+    if normalize_warehouse_size(current_warehouse_size) != normalize_warehouse_size(deployment_warehouse_size):
+        cursor = snowflake_connection.cursor()
+        cursor.execute(f"ALTER WAREHOUSE {warehouse} SET WAREHOUSE_SIZE = '{normalize_warehouse_size(deployment_warehouse_size)}'")
         print(f"Warehouse size updated to {deployment_warehouse_size}")
         cursor.close()
-        conn.close()
         return current_warehouse_size, True
     else:
         print("Warehouse size already matches deployment size.")
-        cursor.close()
-        conn.close()
         return current_warehouse_size, False
 
 
-def revert_warehouse_size(user, account, role, warehouse, database, authenticator, password, original_size, size_changed):
+def revert_warehouse_size(snowflake_connection, warehouse, original_size, size_changed):
     if not size_changed:
         print("No size change detected. No revert needed.")
         return
 
-    conn = snowflake.connector.connect(
-        user=user,
-        account=account,
-        role=role,
-        warehouse=warehouse,
-        database=database,
-        authenticator=authenticator,
-        password=password
-    )
-    cursor = conn.cursor()
-
-    cursor.execute(f"ALTER WAREHOUSE {warehouse} SET WAREHOUSE_SIZE = {original_size.upper()}")
+    cursor = snowflake_connection.cursor()
+
+    cursor.execute(f"ALTER WAREHOUSE {warehouse} SET WAREHOUSE_SIZE = '{normalize_warehouse_size(original_size)}'")
     print(f"Warehouse size reverted to {original_size}")
     cursor.close()
-    conn.close()
+
+
+def get_script_runtime_history(snowflake_connection, autocommit, verbose, change_history_table, script_paths, execute_snowflake_query, columns=(), reference_size=None):
+    # Average successful execution time of every pending script, in one query. Milliseconds are used where
+    # EXECUTION_MS was recorded. Where WAREHOUSE_SIZE was recorded, the times are converted to reference_size first,
+    # every size step halving the time; rows without a size are taken to be measured at reference_size
+    if not script_paths:
+        return dict()
+    path_list = ", ".join("'{0}'".format(path.replace("'", "''")) for path in script_paths)
+    execution_time = "COALESCE(EXECUTION_MS / 1000, EXECUTION_TIME)" if 'EXECUTION_MS' in columns else "EXECUTION_TIME"
+    warehouse_size = "WAREHOUSE_SIZE" if 'WAREHOUSE_SIZE' in columns and reference_size else "NULL"
+    query = """SELECT SCRIPT_PATH, {4}, AVG({5}), COUNT(*) FROM {0}.{1}.{2} WHERE STATUS = 'Success' AND SCRIPT_PATH IN ({3})
+               GROUP BY 1, 2;""".format(change_history_table['database_name'], change_history_table['schema_name'], change_history_table['table_name'], path_list, warehouse_size, execution_time)
+    resultset = execute_snowflake_query(snowflake_connection, query, autocommit, verbose)
+    reference_index = warehouse_sizes.index(normalize_warehouse_size(reference_size)) if reference_size else None
+    totals = dict()
+    for script_path, size, execution_time, count in resultset[0].fetchall():
+        size = normalize_warehouse_size(size) if size else None
+        seconds = float(execution_time)
+        if size in warehouse_sizes and reference_index is not None:
+            seconds *= 2 ** (warehouse_sizes.index(size) - reference_index)
+        total_seconds, total_count = totals.get(script_path, (0.0, 0))
+        totals[script_path] = (total_seconds + seconds * count, total_count + count)
+    return {script_path: total_seconds / total_count for script_path, (total_seconds, total_count) in totals.items()}
+
+
+def get_query_stats(snowflake_connection, autocommit, verbose, query_ids, since_seconds, execute_snowflake_query):
+    # Queued, compilation and execution time and bytes scanned of the given queries, in one query. The
+    # INFORMATION_SCHEMA function has no ingestion delay, it returns at most 10000 queries of the last since_seconds
+    if not query_ids:
+        return dict()
+    id_list = ", ".join("'{0}'".format(query_id.replace("'", "''")) for query_id in query_ids[:10000])
+    query = """SELECT QUERY_ID, TOTAL_ELAPSED_TIME, QUEUED_PROVISIONING_TIME + QUEUED_REPAIR_TIME + QUEUED_OVERLOAD_TIME, COMPILATION_TIME, EXECUTION_TIME, BYTES_SCANNED
+               FROM TABLE(INFORMATION_SCHEMA.QUERY_HISTORY(END_TIME_RANGE_START => DATEADD('second', -{0}, CURRENT_TIMESTAMP()), RESULT_LIMIT => 10000))
+               WHERE QUERY_ID IN ({1});""".format(int(since_seconds) + 60, id_list)
+    resultset = execute_snowflake_query(snowflake_connection, query, autocommit, verbose)
+    return {row[0]: row[1:] for row in resultset[0].fetchall()}
+
+
+def summarize_query_stats(query_ids_by_script, query_stats):
+    # Totals per script from the per query statistics (milliseconds), slowest script first
+    script_stats = []
+    for script_path, query_ids in query_ids_by_script.items():
+        rows = [query_stats[query_id] for query_id in query_ids if query_id in query_stats]
+        if not rows:
+            continue
+        elapsed, queued, compilation, execution, bytes_scanned = (sum(value or 0 for value in column) for column in zip(*rows))
+        script_stats.append({
+            'script': script_path,
+            'queries': len(rows),
+            'elapsed_seconds': elapsed / 1000,
+            'queued_seconds': queued / 1000,
+            'compilation_seconds': compilation / 1000,
+            'execution_seconds': execution / 1000,
+            'bytes_scanned': bytes_scanned
+        })
+    script_stats.sort(key=lambda stats: stats['elapsed_seconds'], reverse=True)
+    return script_stats
+
+
+def advise_warehouse_size(script_paths, runtime_history, current_size, reference_size, max_size, target_seconds, credit_budget=None, default_script_seconds=1):
+    # Predicts the deployment time from the runtime history and picks the smallest size, from the current size up
+    # to max_size, expected to finish within target_seconds and credit_budget. The history is taken to be measured
+    # at reference_size, every size step is assumed to halve the time. Returns the size to resize to (None when the
+    # current size is enough) and the predicted seconds at the size the deployment will run on
+    known_seconds = [runtime_history[path] for path in script_paths if path in runtime_history]
+    unknown_count = len(script_paths) - len(known_seconds)
+    predicted_seconds = sum(known_seconds) + unknown_count * default_script_seconds
+    print(f"Predicted {predicted_seconds:.0f}s at {reference_size} for {len(script_paths)} script(s), {unknown_count} without runtime history")
+
+    current_index = warehouse_sizes.index(normalize_warehouse_size(current_size))
+    reference_index = warehouse_sizes.index(normalize_warehouse_size(reference_size))
+    max_index = max(warehouse_sizes.index(normalize_warehouse_size(max_size)), current_index)
+
+    def seconds_at(index):
+        return predicted_seconds * 2 ** (reference_index - index)
+
+    def credits_at(index):
+        # Billing is per second with a minimum of one minute
+        return 2 ** index * max(seconds_at(index), 60) / 3600
+
+    affordable = [index for index in range(current_index, max_index + 1) if credit_budget is None or credits_at(index) <= credit_budget]
+    if not affordable:
+        print(f"No size from {warehouse_sizes[current_index]} up fits the credit budget of {credit_budget}, keeping {warehouse_sizes[current_index]}")
+        return None, seconds_at(current_index)
+    on_time = [index for index in affordable if seconds_at(index) <= target_seconds]
+    chosen_index = on_time[0] if on_time else affordable[-1]
+    print(f"Predicted {seconds_at(chosen_index):.0f}s and {credits_at(chosen_index):.3f} credit(s) at {warehouse_sizes[chosen_index]}, target {target_seconds:.0f}s")
+
+    if chosen_index == current_index:
+        return None, seconds_at(chosen_index)
+    return warehouse_sizes[chosen_index], seconds_at(chosen_index)